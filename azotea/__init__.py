@@ -33,7 +33,43 @@ from ._version import get_versions
 DEF_WIDTH  = 500
 DEF_HEIGHT = 400
 
-SQL_TEST_STRING = "SELECT COUNT(*) FROM image_t"
+# Number of threads computing image hashes concurrently
+DEF_HASH_WORKERS = os.cpu_count() or 1
+
+# Number of threads reading EXIF metadata when reorganizing images
+DEF_SCAN_WORKERS = os.cpu_count() or 1
+
+# Number of processes computing image statistics
+DEF_STATS_JOBS = 1
+
+# Memory budget in MB for the image statistics processes. 0 means no limit
+DEF_STATS_MEMORY_BUDGET = 0
+
+# Image statistics are committed every so many images or seconds
+DEF_STATS_BATCH_SIZE     = 100
+DEF_STATS_BATCH_INTERVAL = 60.0
+
+# Decoded pixels cache size in MB. 0 disables the cache
+DEF_PIXEL_CACHE_SIZE = 0
+
+# Decoded DARK frames size in MB kept for the master dark when the pixels cache is disabled
+DEF_DARK_PIXELS_SIZE = 4096
+
+# Seconds without new arrivals before a watched directory is reduced
+DEF_WATCH_DEBOUNCE = 30.0
+# Seconds between directory scans when inotify is not available
+DEF_WATCH_INTERVAL = 10.0
+
+# SQLite connection settings, overridable in the [database] section of azotea.ini
+DEF_DB_JOURNAL_MODE = "WAL"
+DEF_DB_SYNCHRONOUS  = "NORMAL"
+DEF_DB_TEMP_STORE   = "MEMORY"
+DEF_DB_CACHE_SIZE   = 64      # MB
+DEF_DB_MMAP_SIZE    = 256     # MB
+DEF_DB_BUSY_TIMEOUT = 30000   # milliseconds
+
+# Schema existence probe, constant time whatever the image_t size
+SQL_TEST_STRING = "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'image_t'"
 
 # Configuration file templates are built-in the package
 DEF_CAMERA_TPL = resource_filename(__name__, os.path.join('data', 'camera.ini'))
@@ -41,6 +77,7 @@ DEF_CONFIG_TPL = resource_filename(__name__, os.path.join('data', 'azotea.ini'))
 SQL_SCHEMA     = resource_filename(__name__, os.path.join('data', 'sql', 'schema.sql'))
 SQL_PURGE      = resource_filename(__name__, os.path.join('data', 'sql', 'purge.sql'))
 SQL_DATA_DIR   = resource_filename(__name__, os.path.join('data', 'sql', 'data' ))
+SQL_MIGRATIONS = resource_filename(__name__, os.path.join('data', 'sql', 'migrations' ))
 
 
 # Configuration file templates are built-in the package
@@ -50,6 +87,8 @@ AZOTEA_BAK_DIR  = os.path.join(AZOTEA_BASE_DIR, "backup")
 AZOTEA_LOG_DIR  = os.path.join(AZOTEA_BASE_DIR, "log")
 AZOTEA_CSV_DIR  = os.path.join(AZOTEA_BASE_DIR, "csv")
 AZOTEA_DB_DIR   = os.path.join(AZOTEA_BASE_DIR, "dbase")
+AZOTEA_DARK_DIR = os.path.join(AZOTEA_BASE_DIR, "dark")
+AZOTEA_PIX_DIR  = os.path.join(AZOTEA_BASE_DIR, "pixels")
 
 # These are in the user's file system
 DEF_CAMERA     = os.path.join(AZOTEA_CFG_DIR, os.path.basename(DEF_CAMERA_TPL))
@@ -27,12 +27,13 @@ import shutil
 from .           import *
 from .exceptions import *
 from .           import __version__
-from .config     import load_config_file, merge_options 
-from .utils      import chop, Point, ROI, open_database, create_database
+from .config     import load_config_file, merge_options, load_database_options 
+from .utils      import chop, Point, ROI, open_database, create_database, migrate_database
 from .cfgcmds    import config_global, config_camera
 from .database   import database_clear, database_purge, database_backup
 from .backup     import backup_list, backup_delete, backup_restore
-from .image      import image_list, image_export, image_reduce
+from .image      import image_list, image_export, image_reduce, dark_build
+from .watch      import image_watch
 from .reorg      import reorganize_images
 from .session    import session_current, session_list
 from .changed    import changed_observer, changed_location, changed_camera, changed_image
@@ -100,6 +101,12 @@ def setup(options):
 	if not os.path.exists(AZOTEA_LOG_DIR):
 		log.info("Creating {0} directory".format(AZOTEA_LOG_DIR))
 		os.mkdir(AZOTEA_LOG_DIR)
+	if not os.path.exists(AZOTEA_DARK_DIR):
+		log.info("Creating {0} directory".format(AZOTEA_DARK_DIR))
+		os.mkdir(AZOTEA_DARK_DIR)
+	if not os.path.exists(AZOTEA_PIX_DIR):
+		log.info("Creating {0} directory".format(AZOTEA_PIX_DIR))
+		os.mkdir(AZOTEA_PIX_DIR)
 	if not os.path.exists(DEF_CONFIG):
 		shutil.copy2(DEF_CONFIG_TPL, DEF_CONFIG)
 		log.info("Created {0} file, please review it".format(DEF_CONFIG))
@@ -131,6 +138,20 @@ def createParser():
 	parser.add_argument('--camera', type=str, default=DEF_CAMERA, help='Optional alternate camera configuration file')
 	parser.add_argument('--config', type=str, default=DEF_CONFIG, help='Optional alternate global configuration file')
 
+	# --------------------------------------------------------
+	# Options shared by all commands running the reduction pipeline
+	# --------------------------------------------------------
+
+	reduce_parser = argparse.ArgumentParser(add_help=False)
+	reduce_parser.add_argument('-m' ,'--multiuser', default=False, action="store_true",     help="Multi-user reduction pipeline flag")
+	reduce_parser.add_argument('-c', '--csv-dir',   type=str, default=AZOTEA_CSV_DIR,       help='Optional directory where the CSV is placed')
+	reduce_parser.add_argument('--hash-workers',    type=int, default=DEF_HASH_WORKERS,     help='Number of concurrent image hashing workers')
+	reduce_parser.add_argument('-j', '--jobs',      type=int, default=DEF_STATS_JOBS,       help='Number of processes computing image statistics')
+	reduce_parser.add_argument('--memory-budget',   type=int, default=DEF_STATS_MEMORY_BUDGET, help='Memory budget in MB for image statistics processes (0 = no limit)')
+	reduce_parser.add_argument('--batch-size',      type=int, default=DEF_STATS_BATCH_SIZE, help='Commit image statistics every so many images')
+	reduce_parser.add_argument('--batch-interval',  type=float, default=DEF_STATS_BATCH_INTERVAL, help='Commit image statistics every so many seconds')
+	reduce_parser.add_argument('--pixel-cache',     type=int, default=DEF_PIXEL_CACHE_SIZE, help='Decoded pixels cache size in MB (0 disables it)')
+
 	# --------------------------
 	# Create first level parsers
 	# --------------------------
@@ -143,6 +164,7 @@ def createParser():
 	parser_database = subparser.add_parser('database', help='database commands (mostly mainteinance)')
 	parser_back     = subparser.add_parser('backup', help='backup management')
 	parser_reorg    = subparser.add_parser('reorganize', help='reorganize commands')
+	parser_dark     = subparser.add_parser('dark', help='master dark commands')
 	parser_session  = subparser.add_parser('session', help='session commands')
 	parser_changed  = subparser.add_parser('changed', help='notify change commands (only for automatized use)')
    
@@ -208,10 +230,24 @@ def createParser():
 
 	subparser = parser_reorg.add_subparsers(dest='subcommand')
 
-	rgi = subparser.add_parser('images',  help="Reorganize images into observation nights")
+	rgi = subparser.add_parser('images',  parents=[reduce_parser], help="Reorganize images into observation nights (reduction options apply with --reduce)")
 	rgi.add_argument('-i', '--input-dir',  type=str, required=True , help='Images input directory')
 	rgi.add_argument('-o','--output-dir', type=str, required=True , help='Images output base diretory')
 	rgi.add_argument('-d', '--dry-run',   action='store_true', help='Show how many directories, do not copy.')
+	rgi.add_argument('--workers',         type=int, default=DEF_SCAN_WORKERS, help='Number of concurrent EXIF reading and file placing workers')
+	rgi.add_argument('--verify',          action='store_true', help='Compare and record content hashes, not just sizes')
+	rgi.add_argument('--mode',            choices=['copy', 'hardlink', 'symlink', 'move', 'reflink'], default='copy', help='How images are placed in output directories')
+	rgi.add_argument('--reduce',          action='store_true', help='Also reduce each night directory, reading every image only once')
+	rgi.set_defaults(reset=False, force_csv=False)
+
+	# ----------------------------------------
+	# Create second level parsers for 'dark'
+	# ----------------------------------------
+
+	subparser = parser_dark.add_subparsers(dest='subcommand')
+
+	dkb = subparser.add_parser('build',  parents=[reduce_parser], help="Build the pixel level master dark of an already reduced working directory")
+	dkb.add_argument('-w' ,'--work-dir',  type=str, required=True, help='Input working directory')
 
 
 	# ----------------------------------------
@@ -273,12 +309,17 @@ def createParser():
 	imeex.add_argument('--master',    action="store_true", help="display master dark data")
 	ime.add_argument('--page-size',   type=int, default=10,  help="display page size")
 
-	ird = subparser.add_parser('reduce',  help='run register/classify/stats</export pipeline')
+	ird = subparser.add_parser('reduce',  parents=[reduce_parser], help='run register/classify/stats</export pipeline')
 	ird.add_argument('-w' ,'--work-dir',  type=str, required=True, help='Input working directory')
 	ird.add_argument('-r' ,'--reset',     default=False, action="store_true",     help="Reprocess from start")
 	ird.add_argument('-f' ,'--force-csv', default=False, action="store_true",     help="Force CSV file generration")
-	ird.add_argument('-m' ,'--multiuser', default=False, action="store_true",     help="Multi-user reduction pipeline flag")
-	ird.add_argument('-c', '--csv-dir',   type=str, default=AZOTEA_CSV_DIR,       help='Optional directory where the CSV is placed')
+
+	iwa = subparser.add_parser('watch',   parents=[reduce_parser], help='reduce newly landed images as they arrive')
+	iwa.add_argument('-w' ,'--work-dir',  type=str, required=True, help='Upload directory tree to watch')
+	iwa.add_argument('--debounce',        type=float, default=DEF_WATCH_DEBOUNCE, help='Seconds without new images before reducing a directory')
+	iwa.add_argument('--interval',        type=float, default=DEF_WATCH_INTERVAL, help='Seconds between directory scans when polling')
+	iwa.add_argument('--polling',         default=False, action="store_true",     help="Poll directories even if inotify is available")
+	iwa.set_defaults(reset=False, force_csv=False)
 
 	iex = subparser.add_parser('export',  help='export the whole database to a CSV file')
 	iex.add_argument('--csv-file',        type=str, default=DEF_GLOBAL_CSV,  help='Optional session CSV file to export')
@@ -298,8 +339,9 @@ def main():
 		configureLogging(options)
 		log.info("=============== AZOTEA {0} ===============".format(__version__))
 		setup(options)
-		connection = open_database(DEF_DBASE)
+		connection = open_database(DEF_DBASE, load_database_options(options.config))
 		create_database(connection, SQL_SCHEMA, SQL_DATA_DIR, SQL_TEST_STRING)
+		migrate_database(connection, SQL_MIGRATIONS)
 		command      = options.command
 		if command == 'init':
 			return
@@ -13,7 +13,7 @@
 import os.path
 import glob
 import logging
-import shutil
+import sqlite3
 
 # Python3 catch
 try:
@@ -30,7 +30,7 @@ except:
 # local imports
 # -------------
 
-from .      import DEF_DBASE, AZOTEA_BASE_DIR
+from .      import AZOTEA_BASE_DIR
 from .utils import paging
 
 # ----------------
@@ -71,10 +71,13 @@ def backup_delete(connection, options):
 
 
 def backup_restore(connection, options):
-	connection.close()
 	backup_file = os.path.join(BACKUP_DIR, options.bak_file)
 	if not options.non_interactive:
 		raw_input("Are you sure ???? <Enter> to continue or [Ctrl-C] to abort")
-	shutil.copy2(backup_file, DEF_DBASE)
+	# Restore through the live connection so that its WAL file is kept consistent
+	source = sqlite3.connect(backup_file)
+	source.backup(connection)
+	source.close()
+	connection.close()
 	log.info("Done.")
 	
\ No newline at end of file
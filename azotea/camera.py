@@ -12,12 +12,12 @@
 
 import os
 import os.path
+import io
 import logging
 import datetime
 import hashlib
 import math
 import re
-import subprocess
 
 try:
     # Python 2
@@ -30,7 +30,6 @@ except:
 # Third party libraries
 # ---------------------
 
-import exifread
 import rawpy
 import numpy as np
 import jdcal
@@ -41,7 +40,8 @@ import jdcal
 
 from .           import DEF_CAMERA_TPL, DEF_TSTAMP
 from .utils      import chop, Point, ROI
-from .exceptions import ConfigError, MetadataError, TimestampError
+from .exif       import read_exif, exiftool_lookup, exiftool_prefetched
+from .exceptions import ConfigError, MetadataError, TimestampError, RoiError
 
 # ----------------
 # Module constants
@@ -53,6 +53,17 @@ G2 = 1
 G3 = 2
 B4 = 3
 
+CHANNELS = ['R1', 'G2', 'G3', 'B4']
+
+# Optional robust statistics computed over the ROI
+EXTRA_STATISTICS = ['median', 'mad', 'percentiles', 'clipped_mean']
+
+# Maximum number of sigma clipping iterations
+CLIP_ITERATIONS = 5
+
+# Named regions of interest measured besides the main ROI
+NAMED_REGIONS = ['center', 'corners', 'rings']
+
 
 BG_X1 = 400
 BG_Y1 = 200
@@ -73,6 +84,19 @@ log = logging.getLogger("azotea")
 # ----------
 
 
+# -----------------------
+# Module global functions
+# -----------------------
+
+def raw_dimensions(filepath):
+    '''Image width and height from EXIF metadata, or None if not available'''
+    with open(filepath, "rb") as f:
+        exif = read_exif(f)
+    for width, height in (('EXIF ExifImageWidth', 'EXIF ExifImageLength'), ('Image ImageWidth', 'Image ImageLength')):
+        if width in exif and height in exif:
+            return int(str(exif[width])), int(str(exif[height]))
+    return None
+
 # =======
 # CLASSES
 # =======
@@ -122,11 +146,106 @@ class CameraCache(object):
 
         
 
+class PixelCache(object):
+    '''
+    Content addressed disk cache of decoded RAW mosaics, keyed by image hash.
+    The Bayer layout is applied when loading, so entries survive camera.ini changes.
+    Least recently used entries are evicted above max_size bytes.
+    '''
+
+    # Evict down to this fraction of max_size, so that the cache directory
+    # is only scanned once every several stored images
+    LOW_WATERMARK = 0.9
+
+    def __init__(self, directory, max_size):
+        self._directory = directory
+        self._max_size  = max_size
+        self._total     = None   # Running cache size estimate, scanned on first store
+
+
+    def path(self, hsh):
+        return os.path.join(self._directory, hsh.hex() + '.npy')
+
+
+    def load(self, hsh):
+        '''Memory mapped RAW mosaic or None if not cached'''
+        path = self.path(hsh)
+        try:
+            raw = np.load(path, mmap_mode='r')
+            os.utime(path)  # Mark as recently used. atime is not reliable
+        except (OSError, ValueError):
+            return None
+        return raw
+
+
+    def store(self, hsh, raw):
+        path = self.path(hsh)
+        tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.save(f, raw, allow_pickle=False)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            log.warning("Could not cache decoded pixels => %s", e)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        if self._total is None or self._total + size > self._max_size:
+            self._total = self.evict()
+        else:
+            self._total += size
+
+
+    def discard(self, hsh):
+        '''Remove an entry no longer needed'''
+        path = self.path(hsh)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        if self._total is not None:
+            self._total = max(0, self._total - size)
+
+
+    def evict(self):
+        '''
+        Remove least recently used entries if the cache exceeds max_size.
+        Returns the resulting cache size in bytes
+        '''
+        entries = []
+        total = 0
+        with os.scandir(self._directory) as it:
+            for entry in it:
+                if not entry.name.endswith('.npy'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue    # Evicted by another process
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        if total <= self._max_size:
+            return total
+        for mtime, size, path in sorted(entries):
+            if total <= self.LOW_WATERMARK * self._max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        return total
+
 
 class CameraImage(object):
 
     ExiftoolFixed = False
 
+    # Ring grid labels shared by all images of the same size
+    RingLabels = {}
+
     HEADERS = [
             'tstamp'         ,
             'name'           ,
@@ -155,14 +274,18 @@ class CameraImage(object):
     # Public API #
     # ========== #
 
-    def __init__(self, filepath, cache):
+    def __init__(self, filepath, cache, buffer=None, pixels=None, hsh=None):
         self.filepath   = filepath
         self.cache      = cache # Camera reading parameters cache
+        self.buffer     = buffer # Optional image file contents already read from disk
+        self.pixels     = pixels # Optional decoded pixels cache
+        self.hash       = hsh    # Image hash, the decoded pixels cache key
         self.roi        = None  # foreground rectangular region where signal is estimated
         self.dkroi      = None  # dark rectangular region where bias is estimated
         self.exif       = None
         self.metadata   = {}  # Subset of EXIF metadata we are interested in
         self.name       = os.path.basename(self.filepath)
+        self.raw        = None  # Whole RAW image, Bayer pattern not yet split
         self.signal     = []    # Bayer array for signal ROI
         self.dark       = []    # Bayer array for dark ROI
         self.path       = filepath  
@@ -170,13 +293,18 @@ class CameraImage(object):
         self.step       = [2, 2, 2, 2]
     
 
-    def loadEXIF(self):
-        '''Load EXIF metadata'''   
+    def loadEXIF(self, exif=None):
+        '''Load EXIF metadata, unless already read by header_exif()'''   
         #log.debug("%s: Loading EXIF metadata",self.name)
-        with open(self.filepath, "rb") as f:
-            logging.disable(logging.INFO)
-            self.exif = exifread.process_file(f, details=False)
-            logging.disable(logging.NOTSET)
+        if exif is not None:
+            self.exif = exif
+        else:
+            self.exif = exiftool_prefetched(self.filepath)
+            if self.exif is not None:
+                CameraImage.ExiftoolFixed = True
+            else:
+                with self._open() as f:
+                    self.exif = read_exif(f)
         if not self.exif:
             self._exiftool()
             #raise MetadataError(self.filepath)
@@ -194,6 +322,14 @@ class CameraImage(object):
         return self.metadata
 
 
+    def setMetadata(self, metadata):
+        '''Use already known metadata instead of loading EXIF'''
+        self.metadata = dict(metadata)
+        self.metadata['name'] = self.name
+        self.model = self.metadata['model']
+        return self.metadata
+
+
     def getExposureTime(self):
         imagetyp = None
         exptime = str(self.exif.get('EXIF ExposureTime', None))
@@ -219,20 +355,32 @@ class CameraImage(object):
     def read(self):
         '''Read RAW pixels''' 
         self._lookup()
-        log.debug("%s: Loading RAW data from %s", self.name, self.model)
-        img = rawpy.imread(self.filepath)
-        log.debug("%s: Color description is %s", self.name, img.color_desc)
+        if self.pixels is not None:
+            self.raw = self.pixels.load(self.hash)
+        if self.raw is None:
+            self.raw = self._decode()
+            if self.pixels is not None:
+                self.pixels.store(self.hash, self.raw)
+        else:
+            log.debug("%s: RAW data loaded from decoded pixels cache", self.name)
         # R1 channel
-        self.signal.append(img.raw_image[self.k[R1].x::self.step[R1], self.k[R1].y::self.step[R1]])
+        self.signal.append(self.raw[self.k[R1].x::self.step[R1], self.k[R1].y::self.step[R1]])
         # G2 channel
-        self.signal.append(img.raw_image[self.k[G2].x::self.step[G2], self.k[G2].y::self.step[G2]])
+        self.signal.append(self.raw[self.k[G2].x::self.step[G2], self.k[G2].y::self.step[G2]])
         # G3 channel
-        self.signal.append(img.raw_image[self.k[G3].x::self.step[G3], self.k[G3].y::self.step[G3]])
+        self.signal.append(self.raw[self.k[G3].x::self.step[G3], self.k[G3].y::self.step[G3]])
         # B4 channel
-        self.signal.append(img.raw_image[self.k[B4].x::self.step[B4], self.k[B4].y::self.step[B4]])
-        # img.close() gives a Segmentation fault, core dumped !!
-        # We can't even use a context manager for this
-        # img.close()
+        self.signal.append(self.raw[self.k[B4].x::self.step[B4], self.k[B4].y::self.step[B4]])
+
+
+    def subtractDark(self, master):
+        '''Subtract a (channel, row, column) master dark from the Bayer planes, cropped to their common size'''
+        for channel in (R1, G2, G3, B4):
+            height = min(self.signal[channel].shape[0], master.shape[1])
+            width  = min(self.signal[channel].shape[1], master.shape[2])
+            self.signal[channel] = self.signal[channel][:height, :width] - master[channel, :height, :width]
+        # Statistics must come from the dark substracted planes from now on
+        self.raw = None
 
 
     def setROI(self, roi):
@@ -257,10 +405,8 @@ class CameraImage(object):
 
         
     def stats(self):
-        r1_mean, r1_vari = self._region_stats(self.signal[R1], self.roi)
-        g2_mean, g2_vari = self._region_stats(self.signal[G2], self.roi)
-        g3_mean, g3_vari = self._region_stats(self.signal[G3], self.roi)
-        b4_mean, b4_vari = self._region_stats(self.signal[B4], self.roi)
+        self._check_roi(self.roi)
+        (r1_mean, r1_vari), (g2_mean, g2_vari), (g3_mean, g3_vari), (b4_mean, b4_vari) = self._roi_stats(self.roi)
         result = {
             'name'            : self.name,
             'roi'             : str(self.roi),
@@ -287,6 +433,63 @@ class CameraImage(object):
         log.debug("%s: ROI = %s, \u03BC = %s, \u03C3 = %s ", self.name, self.roi, mean, stdev)
         return result
 
+    def extra_stats(self, statistics, percentiles=(), clip_sigma=3.0):
+        '''
+        Robust statistics per channel over the ROI of the already decoded image.
+        Uses selection (partitioning) rather than sorting.
+        Returns a list of {'channel', 'statistic', 'value'} dictionaries
+        '''
+        result = []
+        for channel, label in enumerate(CHANNELS):
+            r = self.signal[channel][self.roi.y1:self.roi.y2, self.roi.x1:self.roi.x2]
+            values = np.array(r, dtype=np.float64).ravel()
+            quantiles = [50.0] + [ float(q) for q in percentiles ]
+            # overwrite_input lets numpy partition our private copy in place
+            q = np.percentile(values, quantiles, overwrite_input=True)
+            median = q[0]
+            measures = {}
+            if 'median' in statistics:
+                measures['median'] = median
+            if 'mad' in statistics:
+                measures['mad'] = np.median(np.abs(values - median))
+            if 'percentiles' in statistics:
+                for quantile, value in zip(quantiles[1:], q[1:]):
+                    measures['p{0:g}'.format(quantile)] = value
+            if 'clipped_mean' in statistics:
+                measures['clipped_mean'] = self._clipped_mean(values, median, clip_sigma)
+            for name, value in measures.items():
+                result.append({'channel': label, 'statistic': name, 'value': round(float(value),3)})
+        return result
+
+    def named_stats(self, regions, rings=0, sectors=1):
+        '''
+        Mean and variance per channel over several named regions of the decoded image.
+        Center and corner rectangles have the main ROI size.
+        Rings split the image in concentric annuli, optionally into angular sectors.
+        Returns a list of dictionaries, one per region
+        '''
+        result = []
+        height, width = self.signal[G2].shape
+        w, h = self.roi.dimensions()
+        self._check_roi(ROI(0, w, 0, h))
+        rectangles = []
+        if 'center' in regions:
+            rectangles.append(('center', ROI(0, w, 0, h) + Point((width - w)//2, (height - h)//2)))
+        if 'corners' in regions:
+            rectangles.append(('corner_tl', ROI(0, w, 0, h)))
+            rectangles.append(('corner_tr', ROI(width - w, width, 0, h)))
+            rectangles.append(('corner_bl', ROI(0, w, height - h, height)))
+            rectangles.append(('corner_br', ROI(width - w, width, height - h, height)))
+        for name, region in rectangles:
+            row = {'roi_name': name, 'roi': str(region)}
+            for label, (mean, vari) in zip(CHANNELS, self._roi_stats(region)):
+                row['aver_' + label] = mean
+                row['vari_' + label] = vari
+            result.append(row)
+        if 'rings' in regions and rings > 0:
+            result.extend(self._ring_stats(rings, sectors))
+        return result
+
     # ============== #
     # helper methods #
     # ============== #
@@ -298,6 +501,25 @@ class CameraImage(object):
         year, month, day, fraction = jdcal.jd2gcal(jd2000, mjd)
         return "{0:04d}-{1:02d}-{2:02d}".format(year, month, day)
 
+    def _decode(self):
+        '''Decode RAW pixels with LibRaw'''
+        log.debug("%s: Loading RAW data from %s", self.name, self.model)
+        if self.buffer is not None:
+            img = rawpy.imread(io.BytesIO(self.buffer))
+        else:
+            img = rawpy.imread(self.filepath)
+        log.debug("%s: Color description is %s", self.name, img.color_desc)
+        # img.close() gives a Segmentation fault, core dumped !!
+        # We can't even use a context manager for this
+        # img.close()
+        return img.raw_image
+
+    def _open(self):
+        '''File object to image contents, avoiding disk reads if already in memory'''
+        if self.buffer is not None:
+            return io.BytesIO(self.buffer)
+        return open(self.filepath, "rb")
+
     def _fraction_to_float(self, value):
         try:
             value = float(value)
@@ -332,9 +554,104 @@ class CameraImage(object):
         self.k, self.step = self.cache.lookup(self.model)
 
 
+    def _check_roi(self, region):
+        '''Raise RoiError unless a non empty region fits in every Bayer plane'''
+        for channel in (R1, G2, G3, B4):
+            height, width = self.signal[channel].shape
+            if (region.x1 < 0 or region.y1 < 0 or region.x2 > width or region.y2 > height or 
+                region.x1 == region.x2 or region.y1 == region.y2):
+                raise RoiError("{0} in {1}x{2} Bayer plane of {3}".format(region, width, height, self.name))
+
+
     def _region_stats(self, data, region):
         r = data[region.y1:region.y2, region.x1:region.x2]
-        return round(r.mean(),1), round(r.var(),3)
+        return round(r.mean(dtype=np.float64),1), round(r.var(dtype=np.float64),3)
+
+
+    def _bayer_stats(self, region):
+        '''
+        Mean and variance of the four channels in a single pass over the RAW ROI.
+        Returns None if the camera layout is not a plain 2x2 Bayer pattern
+        or the RAW image is no longer available (dark substracted planes)
+        '''
+        if self.raw is None or self.step != [2, 2, 2, 2] or any(p.x not in (0, 1) or p.y not in (0, 1) for p in self.k):
+            return None
+        rows, cols = region.y2 - region.y1, region.x2 - region.x1
+        block = self.raw[2*region.y1:2*region.y2, 2*region.x1:2*region.x2]
+        if block.shape != (2*rows, 2*cols):
+            return None
+        # block[i, a, j, b] is pixel (i, j) of the channel read at offset (a, b)
+        block = block.reshape(rows, 2, cols, 2)
+        # Exact integer sums, so results do not depend on summation order
+        sums  = np.einsum('iajb->ab', block, dtype=np.int64)
+        sums2 = np.einsum('iajb,iajb->ab', block, block, dtype=np.int64)
+        n = rows * cols
+        result = []
+        for p in self.k:
+            s1 = int(sums[p.x, p.y])
+            s2 = int(sums2[p.x, p.y])
+            result.append((round(s1 / n, 1), round((n*s2 - s1*s1) / (n*n), 3)))
+        return result
+
+
+    def _roi_stats(self, region):
+        '''Mean and variance of the four channels over a rectangular region'''
+        fused = self._bayer_stats(region)
+        if fused is None:
+            fused = [ self._region_stats(self.signal[channel], region) for channel in (R1, G2, G3, B4) ]
+        return fused
+
+
+    def _ring_labels(self, shape, rings, sectors):
+        '''Ring grid cell index of each channel pixel, cached by image shape'''
+        key = (shape, rings, sectors)
+        if key not in CameraImage.RingLabels:
+            height, width = shape
+            y, x = np.mgrid[0:height, 0:width]
+            x = x - (width - 1) / 2.0
+            y = y - (height - 1) / 2.0
+            radius = np.hypot(x, y) / np.hypot(width / 2.0, height / 2.0)
+            ring   = np.minimum((radius * rings).astype(np.intp), rings - 1)
+            angle  = (np.arctan2(y, x) + np.pi) / (2 * np.pi)
+            sector = np.minimum((angle * sectors).astype(np.intp), sectors - 1)
+            CameraImage.RingLabels[key] = (ring * sectors + sector).ravel()
+        return CameraImage.RingLabels[key]
+
+
+    def _ring_stats(self, rings, sectors):
+        '''Mean and variance of all ring grid cells with a couple of passes per channel'''
+        ncells = rings * sectors
+        labels = self._ring_labels(self.signal[G2].shape, rings, sectors)
+        result = []
+        for cell in range(ncells):
+            ring, sector = divmod(cell, sectors)
+            name = "ring{0}".format(ring) if sectors == 1 else "ring{0}_s{1}".format(ring, sector)
+            roi  = "r=[{0:.3f}:{1:.3f}],a=[{2:.0f}:{3:.0f}]".format(ring/rings, (ring+1)/rings, 
+                360.0*sector/sectors - 180, 360.0*(sector+1)/sectors - 180)
+            result.append({'roi_name': name, 'roi': roi})
+        for label, channel in zip(CHANNELS, (R1, G2, G3, B4)):
+            data  = self.signal[channel]
+            # All channels usually share the same shape, but better safe than sorry
+            cells = labels if data.shape == self.signal[G2].shape else self._ring_labels(data.shape, rings, sectors)
+            data  = data.ravel()
+            count = np.bincount(cells, minlength=ncells)
+            mean  = np.bincount(cells, weights=data, minlength=ncells) / np.maximum(count, 1)
+            vari  = np.bincount(cells, weights=(data - mean[cells])**2, minlength=ncells) / np.maximum(count, 1)
+            for row, m, v in zip(result, mean, vari):
+                row['aver_' + label] = round(float(m), 1)
+                row['vari_' + label] = round(float(v), 3)
+        return result
+
+
+    def _clipped_mean(self, values, center, clip_sigma):
+        '''Mean after iteratively rejecting values beyond clip_sigma around the median'''
+        for i in range(CLIP_ITERATIONS):
+            keep = np.abs(values - center) <= clip_sigma * values.std()
+            if keep.all():
+                break
+            values = values[keep]
+            center = np.median(values)
+        return values.mean()
 
 
     def _center_roi(self):
@@ -372,31 +689,10 @@ class CameraImage(object):
         mydict['vari_dark_B4'] = b4_vari_dark
 
     def _exiftool(self):
-        '''Load EXIF Data using exiftool subprocess'''
-        result = subprocess.run(["exiftool", self.filepath],
-                                stdout=subprocess.PIPE, check=True)
-        lines = result.stdout.decode('utf-8').split('\n')
-        # Parse lines using colon as delimiter
-        # and updates the self.exif dictionary
-        exif_re = re.compile(r'^([^:]+):(.+)')
-        for line in lines:
-            matchobj = exif_re.search(line)
-            if matchobj:
-                key   = matchobj.group(1).strip()
-                value = matchobj.group(2).strip()
-                self.exif[key] = value
-
-        # Emulates the expected EXIF keywords used in the main EXIF library
-        self.exif["Image Model"]          = self.exif["Camera Model Name"]
-        self.exif["EXIF ISOSpeedRatings"] = self.exif["ISO"]
-        self.exif["Image DateTime"]       = self.exif["Date/Time Original"]
-        # Focal length requires additional parsing
-        focal_re = re.compile(r'^([^ ]+)')
-        matchobj = focal_re.search(self.exif["Focal Length"])
-        focal = int(float(matchobj.group(1)))
-        self.exif["EXIF FocalLength"]     = focal
-        self.exif["EXIF FNumber"]         = self.exif["F Number"]
-        self.exif["EXIF ExposureTime"]    = self.exif["Exposure Time"]
+        '''Load EXIF Data using the shared exiftool session'''
+        self.exif = exiftool_lookup([self.filepath])[0]
+        if self.exif is None:
+            raise MetadataError(self.filepath)
         CameraImage.ExiftoolFixed = True
 
        
\ No newline at end of file
@@ -28,6 +28,7 @@ except:
 # -------------
 
 from .utils import chop, merge_two_dicts, ROI
+from .camera import EXTRA_STATISTICS, NAMED_REGIONS
 
 # ----------------
 # Module constants
@@ -48,6 +49,26 @@ def valueOrNone(string, typ):
 def valueOrDefault(string, typ, default):
     return default if not len(string) else typ(string)
 
+def optionalGet(parser, section, option, default=''):
+    '''For options not present in older configuration files'''
+    return parser.get(section, option) if parser.has_option(section, option) else default
+
+def load_database_options(filepath):
+    '''
+    Database connection settings from the optional [database] section.
+    Returns a dictionary, with None for settings not given
+    '''
+    parser  = ConfigParser.RawConfigParser()
+    parser.optionxform = str
+    if filepath is not None:
+        parser.read(filepath)
+    options = {}
+    for key in ('journal_mode', 'synchronous', 'temp_store'):
+        options[key] = valueOrNone(optionalGet(parser, "database", key), str)
+    for key in ('cache_size', 'mmap_size', 'busy_timeout'):
+        options[key] = valueOrNone(optionalGet(parser, "database", key), int)
+    return options
+
 def load_config_file(filepath):
     '''
     Load options from configuration file whose path is given
@@ -94,6 +115,24 @@ def load_config_file(filepath):
     options['organization']  = valueOrNone(options['organization'], str)
     options['dark_roi']      = valueOrNone(options['dark_roi'], str)
 
+    # Optional robust statistics
+    options['statistics']    = chop(optionalGet(parser, "stats", "statistics"), ',')
+    options['percentiles']   = [ float(q) for q in chop(optionalGet(parser, "stats", "percentiles"), ',') ]
+    options['clip_sigma']    = valueOrDefault(optionalGet(parser, "stats", "clip_sigma"), float, 3.0)
+    for name in options['statistics']:
+        if name not in EXTRA_STATISTICS:
+            log.warning("Ignoring unknown statistic '%s' in %s", name, filepath)
+    options['statistics']    = [ name for name in options['statistics'] if name in EXTRA_STATISTICS ]
+
+    # Optional named regions of interest
+    options['regions']       = chop(optionalGet(parser, "rois", "regions"), ',')
+    options['rings']         = valueOrDefault(optionalGet(parser, "rois", "rings"), int, 0)
+    options['sectors']       = valueOrDefault(optionalGet(parser, "rois", "sectors"), int, 1)
+    for name in options['regions']:
+        if name not in NAMED_REGIONS:
+            log.warning("Ignoring unknown region '%s' in %s", name, filepath)
+    options['regions']       = [ name for name in options['regions'] if name in NAMED_REGIONS ]
+
     return options
 
 
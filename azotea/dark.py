@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+#--------------------
+# System wide imports
+# -------------------
+
+import os
+import os.path
+import re
+import hashlib
+import logging
+import tempfile
+
+# ---------------------
+# Third party libraries
+# ---------------------
+
+import numpy as np
+
+#--------------
+# local imports
+# -------------
+
+from .        import AZOTEA_DARK_DIR
+from .camera  import CameraImage, R1, G2, G3, B4
+from .utils   import LogCounter
+
+# ----------------
+# Module constants
+# ----------------
+
+N_COUNT = 10
+
+# Maximun size of the DARK stack slice being median combined at once
+CHUNK_SIZE = 64*1024*1024
+
+# Master dark file names are their keys
+RE_MASTER = re.compile(r'^([0-9a-f]{16})\.npy$')
+
+# -----------------------
+# Module global variables
+# -----------------------
+
+log = logging.getLogger("azotea")
+
+# -----------------------
+# Module global functions
+# -----------------------
+
+def master_dark_key(hashes):
+    '''Identifies the set of DARK frames used to build a master dark'''
+    file_hash = hashlib.blake2b(digest_size=8)
+    for hsh in sorted(hashes):
+        file_hash.update(hsh)
+    return file_hash.hexdigest()
+
+
+def master_dark_path(key):
+    '''
+    Master darks are named after the set of DARK frames they are built from,
+    so they can be built before the frames are assigned to a session
+    '''
+    return os.path.join(AZOTEA_DARK_DIR, "{0}.npy".format(key))
+
+
+def master_dark_prune(keep=()):
+    '''Remove master darks whose keys are not in keep'''
+    n = 0
+    for name in os.listdir(AZOTEA_DARK_DIR):
+        matchobj = RE_MASTER.match(name)
+        if matchobj and matchobj.group(1) not in keep:
+            os.remove(os.path.join(AZOTEA_DARK_DIR, name))
+            n += 1
+    if n:
+        log.info("Removed %d unused master darks", n)
+
+
+def master_dark_load(path):
+    '''Memory mapped (channel, row, column) float32 master dark'''
+    return np.load(path, mmap_mode='r')
+
+
+def master_dark_read(file_path, camera_cache, metadata=None, pixels=None, hsh=None):
+    '''
+    Bayer planes of a DARK frame, using cached EXIF metadata if given.
+    Pixels decoded when the frame was measured are taken from the pixels cache
+    '''
+    image = CameraImage(file_path, camera_cache, None, pixels, hsh)
+    if metadata is None:
+        image.loadEXIF()
+    else:
+        image.setMetadata(metadata)
+    image.read()
+    return [ image.signal[channel] for channel in (R1, G2, G3, B4) ]
+
+
+def master_dark_build(frames, camera_cache, key, pixels=None):
+    '''
+    Median stack DARK frames, given as (file path, metadata or None, hash), per Bayer plane.
+    Frames are copied to a disk backed float32 cube which is then
+    median combined in row chunks so that memory usage stays bounded.
+    Unreadable frames are skipped. Raises ValueError if none can be read.
+    '''
+    counter = LogCounter(N_COUNT)
+    fd, cube_path = tempfile.mkstemp(suffix='.npy', dir=AZOTEA_DARK_DIR)
+    os.close(fd)
+    tmp_path = master_dark_path(key) + '.tmp'
+    cube = None
+    try:
+        n = 0
+        for file_path, metadata, hsh in frames:
+            try:
+                planes = master_dark_read(file_path, camera_cache, metadata, pixels, hsh)
+            except Exception:
+                log.warning("%s: Error while reading DARK pixels", os.path.basename(file_path))
+                continue
+            if cube is None:
+                # The first readable frame gives the stack dimensions
+                height = min(plane.shape[0] for plane in planes)
+                width  = min(plane.shape[1] for plane in planes)
+                shape  = (len(frames), len(planes), height, width)
+                log.info("Building master dark from %d DARK frames of %dx%d pixels", len(frames), width, height)
+                cube = np.lib.format.open_memmap(cube_path, mode='w+', dtype=np.float32, shape=shape)
+            try:
+                for channel, plane in enumerate(planes):
+                    cube[n, channel] = plane[:height, :width]
+            except ValueError:
+                log.warning("%s: DARK frame size does not match the others", os.path.basename(file_path))
+                continue
+            n += 1
+            counter.tick("Stacked %03d DARK frames")
+        counter.end("Stacked %03d DARK frames")
+        if n == 0:
+            raise ValueError("No readable DARK frames")
+        cube.flush()
+        rows = max(1, CHUNK_SIZE // (n * len(planes) * width * 4))
+        master = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=shape[1:])
+        for row in range(0, height, rows):
+            master[:, row:row+rows, :] = np.median(cube[:n, :, row:row+rows, :], axis=0)
+        master.flush()
+        del master, cube
+        os.replace(tmp_path, master_dark_path(key))
+    finally:
+        for path in (cube_path, tmp_path):
+            if os.path.exists(path):
+                os.remove(path)
+    return master_dark_path(key)
+
+
+def master_dark_roi_stats(path, roi):
+    '''Mean dark level per channel over the region of interest'''
+    master = master_dark_load(path)
+    region = master[:, roi.y1:roi.y2, roi.x1:roi.x2]
+    return [ round(float(region[channel].mean(dtype=np.float64)), 1) for channel in range(master.shape[0]) ]
@@ -0,0 +1,16 @@
+-------------------------------------------------
+-- Indexes for the per session and per observer
+-- queries of the reduction pipeline and exports
+-------------------------------------------------
+
+-- Register, stats, metadata and classify steps of a session
+CREATE INDEX IF NOT EXISTS image_i3 ON image_t(session, state);
+
+-- Master dark and per night exports of a session
+CREATE INDEX IF NOT EXISTS image_i4 ON image_t(session, type, night, tstamp);
+
+-- Observer metadata changes
+CREATE INDEX IF NOT EXISTS image_i5 ON image_t(observer, state);
+
+-- Let the query planner choose between them with real selectivities
+ANALYZE image_t;
@@ -0,0 +1,14 @@
+----------------------------------------------------------
+-- Persistent cache of image hashes keyed by file path and
+-- stat() info, so that unchanged files are not read again
+----------------------------------------------------------
+
+CREATE TABLE IF NOT EXISTS hash_cache_t
+(
+    path        TEXT    NOT NULL, -- absolute file path
+    size        INTEGER NOT NULL, -- file size in bytes
+    mtime_ns    INTEGER NOT NULL, -- file modification time in nanoseconds
+    inode       INTEGER NOT NULL, -- file inode number
+    hash        BLOB    NOT NULL, -- image hash
+    PRIMARY KEY(path)
+);
@@ -0,0 +1,8 @@
+----------------------------------------------------------
+-- Image quick fingerprint (size, head and tail blocks) for
+-- databases created before it was part of the data model
+----------------------------------------------------------
+
+ALTER TABLE image_t ADD COLUMN fingerprint BLOB;
+
+CREATE INDEX IF NOT EXISTS image_i2 ON image_t(fingerprint);
@@ -0,0 +1,13 @@
+----------------------------------------------------------
+-- Manifests of work directories as of their last
+-- successful reduction
+----------------------------------------------------------
+
+CREATE TABLE IF NOT EXISTS manifest_t
+(
+    work_dir        TEXT    NOT NULL, -- absolute work directory path
+    digest          BLOB    NOT NULL, -- digest of sorted (name, size, mtime) file listing
+    config_mtime_ns INTEGER NOT NULL, -- observer config file modification time in nanoseconds
+    session         INTEGER NOT NULL, -- session of the last successful reduction
+    PRIMARY KEY(work_dir)
+);
@@ -0,0 +1,31 @@
+----------------------------------------------------------
+-- Optional robust statistics and statistics over named
+-- regions of interest
+----------------------------------------------------------
+
+-- One row per image, channel and statistic
+CREATE TABLE IF NOT EXISTS extra_stats_t
+(
+    hash        BLOB    NOT NULL, -- image hash
+    channel     TEXT    NOT NULL, -- R1, G2, G3 or B4
+    statistic   TEXT    NOT NULL, -- median, mad, p<percentile>, clipped_mean
+    value       REAL,             -- statistic value over the ROI
+    PRIMARY KEY(hash, channel, statistic)
+);
+
+-- One row per image and region
+CREATE TABLE IF NOT EXISTS roi_stats_t
+(
+    hash        BLOB    NOT NULL, -- image hash
+    roi_name    TEXT    NOT NULL, -- center, corner_<tl|tr|bl|br>, ring<n>[_s<m>]
+    roi         TEXT    NOT NULL, -- region description
+    aver_R1     REAL,             -- R1 raw signal mean
+    vari_R1     REAL,             -- R1 raw signal variance
+    aver_G2     REAL,             -- G2 raw signal mean
+    vari_G2     REAL,             -- G2 raw signal variance
+    aver_G3     REAL,             -- G3 raw signal mean
+    vari_G3     REAL,             -- G3 raw signal variance
+    aver_B4     REAL,             -- B4 raw signal mean
+    vari_B4     REAL,             -- B4 raw signal variance
+    PRIMARY KEY(hash, roi_name)
+);
@@ -0,0 +1,16 @@
+----------------------------------------------------------
+-- Parsed EXIF metadata, one row per image hash
+----------------------------------------------------------
+
+CREATE TABLE IF NOT EXISTS exif_t
+(
+    hash            BLOB    PRIMARY KEY, -- image hash
+    model           TEXT,                -- camera model
+    iso             TEXT,                -- ISO
+    tstamp          TEXT,                -- ISO 8601 timestamp
+    night           TEXT,                -- observation night, derived from tstamp
+    exptime         REAL,                -- exposure time
+    focal_length    REAL,                -- focal length
+    f_number        REAL,                -- f/ number
+    bias            INTEGER              -- bias level
+);
@@ -0,0 +1,7 @@
+----------------------------------------------------------
+-- Pixel level master dark substracted from LIGHT frames
+-- before measuring them, for databases created before it
+-- was part of the data model
+----------------------------------------------------------
+
+ALTER TABLE image_t ADD COLUMN dark_key TEXT;
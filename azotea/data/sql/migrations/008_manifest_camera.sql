@@ -0,0 +1,7 @@
+----------------------------------------------------------
+-- Camera config file modification time, also part of
+-- work directory manifests. Existing manifests no longer
+-- match, so their directories are reduced once again
+----------------------------------------------------------
+
+ALTER TABLE manifest_t ADD COLUMN camera_mtime_ns INTEGER NOT NULL DEFAULT 0;
@@ -5,5 +5,17 @@
 DROP VIEW  IF EXISTS image_v;
 DROP TABLE IF EXISTS image_t;
 DROP INDEX IF EXISTS image_i1;
+DROP INDEX IF EXISTS image_i2;
+DROP INDEX IF EXISTS image_i3;
+DROP INDEX IF EXISTS image_i4;
+DROP INDEX IF EXISTS image_i5;
 DROP TABLE IF EXISTS master_dark_t;
 DROP TABLE IF EXISTS state_t;
+DROP TABLE IF EXISTS hash_cache_t;
+DROP TABLE IF EXISTS manifest_t;
+DROP TABLE IF EXISTS extra_stats_t;
+DROP TABLE IF EXISTS roi_stats_t;
+DROP TABLE IF EXISTS exif_t;
+
+-- Schema migrations must be applied again
+PRAGMA user_version = 0;
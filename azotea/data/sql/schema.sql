@@ -19,12 +19,14 @@ CREATE TABLE IF NOT EXISTS image_t
     -- Image metadata
     name                TEXT  NOT NULL,   -- Image name without the path
     hash                BLOB,             -- Image hash
+    fingerprint         BLOB,             -- Image quick fingerprint (size, head and tail blocks)
     tstamp              TEXT,             -- ISO 8601 timestamp from EXIF
     night               TEXT,             -- YYYY-MM-DD night where it belongs (as a grouping attribute)
     iso                 TEXT,             -- ISO sensivity from EXIF
     exptime             REAL,             -- exposure time in seconds from EXIF      
     roi                 TEXT,             -- region of interest: [x1:x2,y1:y2]
     dark_roi            TEXT,             -- dark region of interest: [x1:x2,y1:y2], NULL if not used
+    dark_key            TEXT,             -- pixel level master dark substracted before measuring, NULL if none
     bias                INTEGER DEFAULT 0, -- Common BIAS level for all channels
     scale               REAL,             -- image scale in arcsec/pixel
 
@@ -57,6 +59,7 @@ CREATE TABLE IF NOT EXISTS image_t
 );
 
 CREATE INDEX IF NOT EXISTS image_i1 ON image_t(name);
+CREATE INDEX IF NOT EXISTS image_i2 ON image_t(fingerprint);
 
 CREATE TABLE IF NOT EXISTS state_t (
     state              INTEGER,
@@ -12,7 +12,7 @@
 
 import os.path
 import logging
-import shutil
+import sqlite3
 import datetime
 import glob
 
@@ -24,7 +24,9 @@ import glob
 # local imports
 # -------------
 
-from . import  *
+from .      import  *
+from .dark  import master_dark_prune
+from .image import dark_prune
 
 # ----------------
 # Module constants
@@ -50,17 +52,29 @@ def latest_session(connection):
     return cursor.fetchone()[0]
 
 
-def dbase_do_backup(comment):
+def dbase_do_backup(connection, comment):
+    '''Online backup, consistent even with pending WAL pages or other connections writing'''
     tstamp = datetime.datetime.utcnow().strftime(".%Y%m%d%H%M%S")
     filename = os.path.basename(DEF_DBASE) + tstamp
     dest_file = os.path.join(AZOTEA_BAK_DIR, filename)
-    shutil.copy2(DEF_DBASE, dest_file)
+    destination = sqlite3.connect(dest_file)
+    with destination:
+        connection.backup(destination)
+    destination.close()
     log.info("database backup to {0}".format(dest_file))
 
 
 def dbase_delete_selected_images(connection, session):
     row = {'session': session}
     cursor = connection.cursor()
+    cursor.execute('''
+        DELETE FROM extra_stats_t
+        WHERE hash IN (SELECT hash FROM image_t WHERE session == :session)
+        ''', row)
+    cursor.execute('''
+        DELETE FROM roi_stats_t
+        WHERE hash IN (SELECT hash FROM image_t WHERE session == :session)
+        ''', row)
     cursor.execute('''
         DELETE FROM image_t
         WHERE session == :session 
@@ -74,6 +88,14 @@ def dbase_delete_selected_master_dark(connection, session):
         WHERE session == :session 
         ''', row)
 
+def dbase_delete_selected_manifests(connection, session):
+    row = {'session': session}
+    cursor = connection.cursor()
+    cursor.execute('''
+        DELETE FROM manifest_t
+        WHERE session == :session 
+        ''', row)
+
 # =====================
 # Command esntry points
 # =====================
@@ -84,13 +106,18 @@ def database_clear(connection, options):
     if options.all:
         cursor.execute("DELETE FROM image_t")
         cursor.execute("DELETE FROM master_dark_t")
+        cursor.execute("DELETE FROM manifest_t")
+        cursor.execute("DELETE FROM extra_stats_t")
+        cursor.execute("DELETE FROM roi_stats_t")
         log.info("Cleared all data from database {0}".format(os.path.basename(DEF_DBASE)))
     else:
         session = latest_session(connection)
         dbase_delete_selected_master_dark(connection, session)
+        dbase_delete_selected_manifests(connection, session)
         dbase_delete_selected_images(connection, session)
         log.info("Cleared data from session {1} in database {0}, ".format(os.path.basename(DEF_DBASE), session))
     connection.commit()
+    dark_prune(connection)
 
 
 
@@ -102,9 +129,10 @@ def database_purge(connection, options):
     connection.executescript(script)
     connection.commit()    
     log.info("Erased schema in database {0}".format(os.path.basename(DEF_DBASE)))
+    master_dark_prune()
 
 
 
 def database_backup(connection, options):
-    connection.close()
-    dbase_do_backup(options.comment)
\ No newline at end of file
+    dbase_do_backup(connection, options.comment)
+    connection.close()
\ No newline at end of file
@@ -55,3 +55,12 @@ class TimestampError(ValueError):
             s = "{0}: '{1}'".format(s, self.args[0])
         s = '{0}.'.format(s)
         return s
+
+class RoiError(ConfigError):
+    '''Region of interest does not fit in the image Bayer planes'''
+    def __str__(self):
+        s = self.__doc__
+        if self.args:
+            s = "{0}: '{1}'".format(s, self.args[0])
+        s = '{0}.'.format(s)
+        return s
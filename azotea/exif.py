@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+#--------------------
+# System wide imports
+# -------------------
+
+import os
+import json
+import atexit
+import struct
+import logging
+import fractions
+import threading
+import subprocess
+
+# ---------------------
+# Third party libraries
+# ---------------------
+
+import exifread
+
+# ----------------
+# Module constants
+# ----------------
+
+# TIFF based RAW formats (CR2, NEF, ARW, DNG ...) keep IFD0 and the EXIF IFD
+# near the file start, so this is usually all we need to read
+HEADER_SIZE = 64*1024
+
+# TIFF field type => item size in bytes
+TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 8: 2, 9: 4, 10: 8}
+
+EXIF_IFD_POINTER = 0x8769
+
+# Tags we are interested in, using exifread naming so that callers do not care
+IFD0_TAGS = {
+    0x0100: 'Image ImageWidth',
+    0x0101: 'Image ImageLength',
+    0x0110: 'Image Model',
+    0x0132: 'Image DateTime',
+}
+
+EXIF_TAGS = {
+    0x829A: 'EXIF ExposureTime',
+    0x829D: 'EXIF FNumber',
+    0x8827: 'EXIF ISOSpeedRatings',
+    0x920A: 'EXIF FocalLength',
+    0xA002: 'EXIF ExifImageWidth',
+    0xA003: 'EXIF ExifImageLength',
+}
+
+# Without these, the fast reader result is useless
+REQUIRED_TAGS = ('Image Model', 'Image DateTime', 'EXIF ExposureTime')
+
+# exiftool executable, overridable for testing purposes
+EXIFTOOL = os.environ.get('AZOTEA_EXIFTOOL', 'exiftool')
+
+# Maximun number of files per exiftool command
+EXIFTOOL_BATCH = 256
+
+# -----------------------
+# Module global variables
+# -----------------------
+
+log = logging.getLogger("azotea")
+
+# Shared exiftool session, started on first use
+_exiftool = None
+_exiftool_lock = threading.Lock()
+
+# exiftool results looked up in batches ahead of use, keyed by file path
+_exiftool_prefetched = {}
+
+# -----------------------
+# Module global functions
+# -----------------------
+
+def _value(data, endian, ftype, count, offset):
+    size = TYPE_SIZES[ftype] * count
+    if offset + size > len(data):
+        raise ValueError("value beyond header")
+    raw = data[offset:offset+size]
+    if ftype == 2:
+        return raw.split(b'\x00', 1)[0].decode('ascii', errors='replace').strip()
+    if ftype == 3:
+        return struct.unpack_from(endian + 'H', raw)[0]
+    if ftype in (4, 9):
+        return struct.unpack_from(endian + ('L' if ftype == 4 else 'l'), raw)[0]
+    if ftype in (5, 10):
+        num, den = struct.unpack_from(endian + ('LL' if ftype == 5 else 'll'), raw)
+        return fractions.Fraction(num, den) if den else fractions.Fraction(0)
+    return raw
+
+
+def _ifd(data, endian, offset, tags):
+    '''Selected tags of the IFD at offset, plus the EXIF IFD pointer if any'''
+    result = {}
+    pointer = None
+    (n,) = struct.unpack_from(endian + 'H', data, offset)
+    for i in range(n):
+        entry = offset + 2 + 12*i
+        tag, ftype, count = struct.unpack_from(endian + 'HHL', data, entry)
+        if ftype not in TYPE_SIZES:
+            continue
+        if tag == EXIF_IFD_POINTER:
+            pointer = struct.unpack_from(endian + 'L', data, entry + 8)[0]
+        elif tag in tags:
+            if TYPE_SIZES[ftype] * count <= 4:
+                value_offset = entry + 8
+            else:
+                value_offset = struct.unpack_from(endian + 'L', data, entry + 8)[0]
+            result[tags[tag]] = _value(data, endian, ftype, 1 if ftype != 2 else count, value_offset)
+    return result, pointer
+
+
+def tiff_exif(data):
+    '''
+    Parse the few EXIF tags we need from the start of a TIFF based file.
+    Returns a dictionary keyed as exifread would or None if not possible
+    '''
+    try:
+        if data[:4] == b'II*\x00':
+            endian = '<'
+        elif data[:4] == b'MM\x00*':
+            endian = '>'
+        else:
+            return None
+        (offset,) = struct.unpack_from(endian + 'L', data, 4)
+        result, pointer = _ifd(data, endian, offset, IFD0_TAGS)
+        if pointer is not None:
+            exif, _ = _ifd(data, endian, pointer, EXIF_TAGS)
+            result.update(exif)
+    except (struct.error, ValueError):
+        return None
+    if not all(tag in result for tag in REQUIRED_TAGS):
+        return None
+    return result
+
+
+def read_exif(f):
+    '''EXIF metadata from a binary file object, reading only its header if possible'''
+    result = tiff_exif(f.read(HEADER_SIZE))
+    if result is None:
+        f.seek(0)
+        logging.disable(logging.INFO)
+        result = exifread.process_file(f, details=False)
+        logging.disable(logging.NOTSET)
+    return result
+
+
+def exiftool_session():
+    '''The exiftool session shared by all images in this process'''
+    global _exiftool
+    with _exiftool_lock:
+        if _exiftool is None:
+            _exiftool = ExifTool()
+            atexit.register(_exiftool.close)
+    return _exiftool
+
+
+def exiftool_lookup(filepaths):
+    '''Batch EXIF lookup of files exifread could not handle'''
+    return exiftool_session().lookup(filepaths)
+
+
+def header_exif(filepath):
+    '''
+    EXIF metadata read by the fast TIFF header reader, to be handed over to
+    CameraImage.loadEXIF(), or None if only exiftool can handle this file
+    '''
+    with open(filepath, 'rb') as f:
+        return tiff_exif(f.read(HEADER_SIZE))
+
+
+def exiftool_prefetch(filepaths):
+    '''
+    Look up with exiftool, EXIFTOOL_BATCH files per command, the EXIF metadata
+    of files the fast reader cannot handle, to be picked by exiftool_prefetched()
+    '''
+    for i in range(0, len(filepaths), EXIFTOOL_BATCH):
+        batch = filepaths[i:i+EXIFTOOL_BATCH]
+        try:
+            results = exiftool_lookup(batch)
+        except OSError as e:
+            log.debug("exiftool not available => %s", e)
+            return
+        with _exiftool_lock:
+            _exiftool_prefetched.update(
+                (filepath, exif) for filepath, exif in zip(batch, results) if exif is not None)
+
+
+def exiftool_prefetched(filepath):
+    '''EXIF metadata of a file already looked up by exiftool_prefetch() or None'''
+    with _exiftool_lock:
+        return _exiftool_prefetched.pop(filepath, None)
+
+
+# =======
+# CLASSES
+# =======
+
+class ExifTool(object):
+    '''
+    Long lived exiftool process answering JSON queries (-stay_open mode),
+    so that Perl startup is paid once per run and not once per image
+    '''
+
+    READY = b'{ready}'
+
+    def __init__(self, executable=EXIFTOOL):
+        self._process = subprocess.Popen(
+            [executable, '-stay_open', 'True', '-@', '-'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        # Commands from concurrent threads must not interleave
+        self._lock = threading.Lock()
+
+
+    def execute(self, *args):
+        '''Run a single exiftool command and return its output'''
+        command = '\n'.join(args + ('-execute', ''))
+        output = []
+        with self._lock:
+            self._process.stdin.write(command.encode('utf-8'))
+            self._process.stdin.flush()
+            while True:
+                line = self._process.stdout.readline()
+                if not line:
+                    raise IOError("exiftool session ended unexpectedly")
+                if line.rstrip() == self.READY:
+                    break
+                output.append(line)
+        return b''.join(output)
+
+
+    def lookup(self, filepaths):
+        '''
+        EXIF metadata of several files in one go, keyed as exifread would.
+        Files exiftool could not make sense of are given as None
+        '''
+        output = self.execute('-json', '-charset', 'filename=utf8', *filepaths)
+        found = { item['SourceFile']: item for item in json.loads(output.decode('utf-8') or '[]') }
+        return [ self._emulate(found.get(filepath, {})) for filepath in filepaths ]
+
+
+    def close(self):
+        if self._process.poll() is None:
+            self._process.stdin.write(b'-stay_open\nFalse\n')
+            self._process.stdin.flush()
+            self._process.wait()
+
+
+    def _emulate(self, item):
+        '''Emulates the expected EXIF keywords used in the main EXIF library'''
+        if not all(key in item for key in ('Model', 'ISO', 'DateTimeOriginal', 'FocalLength', 'FNumber', 'ExposureTime')):
+            return None
+        exif = { key: str(value) for key, value in item.items() }
+        exif["Image Model"]          = exif["Model"]
+        exif["EXIF ISOSpeedRatings"] = exif["ISO"]
+        exif["Image DateTime"]       = exif["DateTimeOriginal"]
+        # Focal length comes as "18.0 mm"
+        exif["EXIF FocalLength"]     = int(float(exif["FocalLength"].split()[0]))
+        exif["EXIF FNumber"]         = exif["FNumber"]
+        exif["EXIF ExposureTime"]    = exif["ExposureTime"]
+        return exif
+
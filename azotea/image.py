@@ -15,6 +15,7 @@ import sqlite3
 import os.path
 import glob
 import logging
+import logging.handlers
 import csv
 import datetime
 import math
@@ -22,6 +23,16 @@ import hashlib
 import time
 import re
 import collections
+import itertools
+import functools
+import multiprocessing
+import concurrent.futures
+
+try:
+    # Unix only
+    import resource
+except ImportError:
+    resource = None
 
 # ---------------------
 # Third party libraries
@@ -31,11 +42,16 @@ import collections
 # local imports
 # -------------
 
-from .           import AZOTEA_CSV_DIR, AZOTEA_CFG_DIR
-from .camera     import CameraImage, CameraCache, MetadataError, ConfigError
+from .           import AZOTEA_CSV_DIR, AZOTEA_CFG_DIR, AZOTEA_PIX_DIR, DEF_HASH_WORKERS
+from .           import DEF_DARK_PIXELS_SIZE, DEF_CAMERA_TPL
+from .camera     import CameraImage, CameraCache, PixelCache, MetadataError, ConfigError, raw_dimensions
+from .exif       import header_exif, exiftool_prefetch
 from .utils      import merge_two_dicts, paging, LogCounter
 from .exceptions import MixingCandidates, NoUserInfoError
 from .config     import load_config_file, merge_options
+from .dark       import master_dark_key, master_dark_path, master_dark_prune, master_dark_load
+from .dark       import master_dark_build, master_dark_roi_stats
+from .utils      import ROI
 
 
 # ----------------
@@ -61,12 +77,21 @@ UNKNOWN     = "UNKNOWN"
 
 N_COUNT = 50
 
+# Size of head and tail blocks read for a quick image fingerprint
+QUICK_BLOCK_SIZE = 65536
+
 # -----------------------
 # Module global variables
 # -----------------------
 
 log = logging.getLogger("azotea")
 
+# Decoded pixels caches, one per (directory, size) in each process
+_pixel_caches = {}
+
+# Last session id handed out by this process
+_last_session = 0
+
 
 if sys.version_info[0] == 2:
     import errno
@@ -99,6 +124,20 @@ def classification_algorithm2(name,  file_path, options):
     return result
 
 
+def session_new():
+    '''
+    New session id from the current UTC time, with one second resolution.
+    Waits for the next second if the previous session was started in the current one
+    '''
+    global _last_session
+    session = int(datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S"))
+    while session <= _last_session:
+        time.sleep(0.1)
+        session = int(datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S"))
+    _last_session = session
+    return session
+
+
 def session_processed(connection, session):
     row = {'session': session, 'state': STATS_COMPUTED}
     cursor = connection.cursor()
@@ -111,6 +150,18 @@ def session_processed(connection, session):
     return cursor.fetchone()[0]
 
 
+def session_interrupted(connection, session):
+    '''A session whose last reduction did not complete, as it has no directory manifest'''
+    row = {'session': session}
+    cursor = connection.cursor()
+    cursor.execute('''
+        SELECT COUNT(*) 
+        FROM manifest_t 
+        WHERE session = :session
+        ''',row)
+    return cursor.fetchone()[0] == 0
+
+
 def latest_session(connection):
     '''Get Last recorded session'''
     cursor = connection.cursor()
@@ -128,13 +179,16 @@ def myopen(name, *args):
         return open(name,  *args, newline='')
 
 
-def hash(filepath):
-    '''Compute a hash from the image'''
+def hash(filepath, quick=False):
+    '''Compute a hash from the image.
+    The quick mode fingerprint only covers the file size and its head and tail blocks'''
     BLOCK_SIZE = 1048576 # 1MByte, the size of each read from the file
     
     # md5() was the fastest algorithm I've tried
     # but I detected a collision, so I now use blake2b with twice the digest size
     
+    if quick:
+        return quick_hash(filepath)
     file_hash = hashlib.blake2b(digest_size=32)
     #file_hash = hashlib.md5()
     with open(filepath, 'rb') as f:
@@ -145,6 +199,162 @@ def hash(filepath):
     return file_hash.digest()
 
 
+def ingest(filepath):
+    '''Read the whole image file once.
+    Returns its contents, to be shared by EXIF and RAW decoding, and its hash'''
+    with open(filepath, 'rb') as f:
+        buffer = f.read()
+    file_hash = hashlib.blake2b(digest_size=32)
+    file_hash.update(buffer)
+    return buffer, file_hash.digest()
+
+
+def quick_hash(filepath):
+    '''Compute a quick fingerprint from the image size, head and tail blocks'''
+    file_hash = hashlib.blake2b(digest_size=16)
+    with open(filepath, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        file_hash.update(size.to_bytes(8, 'little'))
+        file_hash.update(f.read(QUICK_BLOCK_SIZE))
+        if size > QUICK_BLOCK_SIZE:
+            f.seek(max(QUICK_BLOCK_SIZE, size - QUICK_BLOCK_SIZE))
+            file_hash.update(f.read(QUICK_BLOCK_SIZE))
+    return file_hash.digest()
+
+
+def hash_files(file_list, workers=DEF_HASH_WORKERS, quick=False):
+    '''Compute hashes for a list of files using a pool of worker threads.
+    Hashes are returned in the same order as the input file list'''
+    # Both file reads and blake2b updates over large buffers release the GIL
+    # so threads are enough to keep several files being hashed at once
+    if quick:
+        hash_func, message = quick_hash, "Computed %03d quick fingerprints"
+        counter = LogCounter(N_COUNT, level=logging.DEBUG)
+    else:
+        hash_func, message = hash, "Computed %03d full hashes"
+        counter = LogCounter(N_COUNT)
+    hashes  = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for hsh in executor.map(hash_func, file_list):
+            hashes.append(hsh)
+            counter.tick(message, level=logging.DEBUG)
+    counter.end(message)
+    return hashes
+
+
+# -----------------
+# Image hashes cache
+# -----------------
+
+def hash_cache_stat(file_list):
+    rows = []
+    for filepath in file_list:
+        st = os.stat(filepath)
+        rows.append({
+            'path'    : os.path.abspath(filepath),
+            'size'    : st.st_size,
+            'mtime_ns': st.st_mtime_ns,
+            'inode'   : st.st_ino,
+            'hash'    : None,
+            'fingerprint': None,
+        })
+    return rows
+
+
+def hash_cache_lookup(connection, rows):
+    '''Fills in the hash of rows whose file has not changed since cached'''
+    cursor = connection.cursor()
+    for row in rows:
+        cursor.execute(
+            '''
+            SELECT hash
+            FROM hash_cache_t
+            WHERE path     = :path
+            AND   size     = :size
+            AND   mtime_ns = :mtime_ns
+            AND   inode    = :inode
+            ''', row)
+        result = cursor.fetchone()
+        if result:
+            row['hash'] = result[0]
+
+
+def hash_cache_update(connection, rows):
+    cursor = connection.cursor()
+    cursor.executemany(
+        '''
+        INSERT OR REPLACE INTO hash_cache_t (path, size, mtime_ns, inode, hash)
+        VALUES (:path, :size, :mtime_ns, :inode, :hash)
+        ''', rows)
+    connection.commit()
+
+
+# ------------------------
+# Image quick fingerprints
+# ------------------------
+
+def fingerprint_classify(connection, rows, workers=DEF_HASH_WORKERS):
+    '''Classify files as certainly new, certainly known or needing a full hash.
+    Fills in the hash of certainly known files from the database'''
+    fingerprints = hash_files([ row['path'] for row in rows ], workers, quick=True)
+    c = collections.Counter(fingerprints)
+    cursor = connection.cursor()
+    new = known = collisions = 0
+    for row, fingerprint in zip(rows, fingerprints):
+        row['fingerprint'] = fingerprint
+        cursor.execute(
+            '''
+            SELECT hash
+            FROM image_t
+            WHERE fingerprint = :fingerprint
+            LIMIT 2
+            ''', row)
+        result = cursor.fetchall()
+        if not result:
+            new += 1
+        elif len(result) == 1 and c[fingerprint] == 1:
+            row['hash'] = result[0][0]
+            known += 1
+        else:
+            collisions += 1
+    log.info("Quick fingerprints: %d new, %d known, %d collisions", new, known, collisions)
+
+
+def fingerprint_backfill(connection, rows):
+    '''Sets fingerprints of images registered before fingerprints existed'''
+    cursor = connection.cursor()
+    cursor.executemany(
+        '''
+        UPDATE image_t
+        SET fingerprint = :fingerprint
+        WHERE hash = :hash
+        AND fingerprint IS NULL
+        ''', rows)
+    connection.commit()
+
+
+def hash_files_cached(connection, file_list, workers=DEF_HASH_WORKERS, hasher=None):
+    '''Compute hashes for a list of files, reading only new or changed files.
+    Files needing a full hash are handed to hasher, if given, as a list of paths.
+    Returns (hash, fingerprint) tuples in the same order as the input file list.
+    Fingerprints are None for files found in the cache'''
+    rows = hash_cache_stat(file_list)
+    hash_cache_lookup(connection, rows)
+    missing = [ row for row in rows if row['hash'] is None ]
+    log.info("Found %d hashes in cache, %d files to be read", len(rows) - len(missing), len(missing))
+    if missing:
+        fingerprint_classify(connection, missing, workers)
+        unknown = [ row for row in missing if row['hash'] is None ]
+        if unknown:
+            paths  = [ row['path'] for row in unknown ]
+            hashes = hasher(paths) if hasher else hash_files(paths, workers)
+            for row, hsh in zip(unknown, hashes):
+                row['hash'] = hsh
+            fingerprint_backfill(connection, unknown)
+        hash_cache_update(connection, missing)
+    return [ (row['hash'], row['fingerprint']) for row in rows ]
+
+
 def find_by_hash(connection, hash):
     row = {'hash': hash}
     cursor = connection.cursor()
@@ -181,33 +391,53 @@ def detect_dupl_hashes(names_hashes_list):
                     log.error("Image {0} has a clashing hash {1} ".format(name, hsh))
 
 
-def register_slow_candidates(connection, names_hashes_list):
+def register_candidates(connection, names_hashes_list):
+    '''Insert candidates in a single transaction.
+    Returns the names of candidates rejected for a duplicate hash in the same dir'''
     cursor = connection.cursor()
-    for item in names_hashes_list:
-        try:
-            cursor.execute("INSERT INTO candidate_t (name,hash) VALUES (:name,:hash)", item)
-        except sqlite3.IntegrityError as e:
-            connection.rollback()
-            log.warning("Ignoring duplicate candidate in the same dir => %s", item['name'])
-        else:
-            connection.commit()
+    try:
+        # Leftovers from an interrupted reduction on a long lived connection
+        cursor.execute("DROP TABLE IF EXISTS candidate_t")
+        cursor.execute("DROP TABLE IF EXISTS candidate_all_t")
+        cursor.execute("CREATE TEMP TABLE candidate_t (name TEXT, hash BLOB, fingerprint BLOB, PRIMARY KEY(hash))")
+        cursor.execute("CREATE TEMP TABLE candidate_all_t (name TEXT, hash BLOB, fingerprint BLOB)")
+        cursor.executemany("INSERT INTO candidate_all_t (name,hash,fingerprint) VALUES (:name,:hash,:fingerprint)", names_hashes_list)
+        # The first file in name order wins, as if inserted one by one
+        cursor.execute(
+            '''
+            INSERT OR IGNORE INTO candidate_t (name,hash,fingerprint)
+            SELECT name, hash, fingerprint
+            FROM candidate_all_t
+            ORDER BY name ASC
+            ''')
+        cursor.execute(
+            '''
+            SELECT name
+            FROM candidate_all_t
+            WHERE name NOT IN (SELECT name FROM candidate_t)
+            ORDER BY name ASC
+            ''')
+        rejected = [ name for name, in cursor.fetchall() ]
+        cursor.execute("DROP TABLE candidate_all_t")
+    except sqlite3.Error:
+        connection.rollback()
+        raise
+    else:
+        connection.commit()
+    for name in rejected:
+        log.warning("Ignoring duplicate candidate in the same dir => %s", name)
+    return rejected
 
 
-def work_dir_to_session(connection, work_dir, filt):
+def work_dir_to_session(connection, work_dir, filt, workers=DEF_HASH_WORKERS, hasher=None):
     file_list  = sorted(glob.glob(os.path.join(work_dir, filt)))
     log.info("Found {0} candidates matching filter {1}.".format(len(file_list), filt))
-    log.info("Computing hashes. This may take a while")
-    names_hashes_list = [ {'name': os.path.basename(p), 'hash': hash(p)} for p in file_list ]
+    log.info("Computing hashes with %d workers. This may take a while", workers)
+    hashes_list = hash_files_cached(connection, file_list, workers, hasher)
+    names_hashes_list = [ {'name': os.path.basename(p), 'hash': h, 'fingerprint': fp} for p, (h, fp) in zip(file_list, hashes_list) ]
     detect_dupl_hashes(names_hashes_list)
+    register_candidates(connection, names_hashes_list)
     cursor = connection.cursor()
-    cursor.execute("CREATE TEMP TABLE candidate_t (name TEXT, hash BLOB, PRIMARY KEY(hash))")
-    try:
-        cursor.executemany("INSERT INTO candidate_t (name,hash) VALUES (:name,:hash)", names_hashes_list)
-    except sqlite3.IntegrityError as e:
-        connection.rollback()
-        register_slow_candidates(connection, names_hashes_list)
-    else:
-        connection.commit()
     # Common images to database and work-dir
     cursor.execute(
         '''
@@ -227,6 +457,64 @@ def work_dir_to_session(connection, work_dir, filt):
     return session
 
 
+# ------------------------
+# Work directory manifests
+# ------------------------
+
+def manifest_compute(work_dir, config, camera):
+    '''
+    Digest of a work directory listing without reading any file,
+    plus the observer and camera configuration files modification times
+    '''
+    with os.scandir(work_dir) as it:
+        entries = [ (entry.name, entry.stat()) for entry in it if entry.is_file() ]
+    file_hash = hashlib.blake2b(digest_size=32)
+    for name, st in sorted(entries, key=lambda item: item[0]):
+        file_hash.update("{0}\0{1}\0{2}\n".format(name, st.st_size, st.st_mtime_ns).encode('utf-8'))
+    # CameraCache falls back to the package camera.ini as well
+    if not os.path.exists(camera):
+        camera = DEF_CAMERA_TPL
+    return {
+        'work_dir'       : os.path.abspath(work_dir),
+        'digest'         : file_hash.digest(),
+        'config_mtime_ns': os.stat(config).st_mtime_ns,
+        'camera_mtime_ns': os.stat(camera).st_mtime_ns,
+    }
+
+
+def manifest_unchanged(connection, manifest):
+    cursor = connection.cursor()
+    cursor.execute(
+        '''
+        SELECT COUNT(*)
+        FROM manifest_t
+        WHERE work_dir        = :work_dir
+        AND   digest          = :digest
+        AND   config_mtime_ns = :config_mtime_ns
+        AND   camera_mtime_ns = :camera_mtime_ns
+        ''', manifest)
+    return cursor.fetchone()[0] > 0
+
+
+def manifest_update(connection, manifest, session):
+    row = merge_two_dicts(manifest, {'session': session})
+    cursor = connection.cursor()
+    cursor.execute(
+        '''
+        INSERT OR REPLACE INTO manifest_t (work_dir, digest, config_mtime_ns, camera_mtime_ns, session)
+        VALUES (:work_dir, :digest, :config_mtime_ns, :camera_mtime_ns, :session)
+        ''', row)
+    connection.commit()
+
+
+def manifest_delete(connection, work_dir):
+    '''Forget a work directory manifest, so that it is reduced again'''
+    row = {'work_dir': os.path.abspath(work_dir)}
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM manifest_t WHERE work_dir = :work_dir", row)
+    connection.commit()
+
+
 def work_dir_cleanup(connection):
     cursor = connection.cursor()
     cursor.execute("DROP TABLE IF EXISTS candidate_t")
@@ -249,53 +537,79 @@ def master_dark_for(connection, session):
 # Image Register
 # --------------
 
-def register_insert_image(connection, row):
-    '''slow version to find out the exact duplicate'''
+def register_insert_images(connection, rows):
+    '''Register images in a single transaction.
+    Returns (name, registered name) pairs for images rejected as duplicates'''
     cursor = connection.cursor()
-    cursor.execute(
+    try:
+        cursor.execute("DROP TABLE IF EXISTS register_t")
+        cursor.execute(
             '''
-            INSERT OR IGNORE INTO image_t (
+            CREATE TEMP TABLE register_t (
+                name        TEXT,
+                hash        BLOB,
+                fingerprint BLOB,
+                session     INTEGER,
+                type        TEXT,
+                state       INTEGER,
+                changes     INTEGER
+            )
+            ''')
+        cursor.executemany(
+            '''
+            INSERT INTO register_t (
                 name, 
                 hash,
-                session, 
+                fingerprint,
+                session,
                 type,
                 state,
-                meta_changes
+                changes
             ) VALUES (
                 :name, 
                 :hash,
-                :session,
+                :fingerprint,
+                :session, 
                 :type,
                 :state,
                 :changes
             )
-            ''', row)
-    connection.commit()
-    
-
-def register_insert_images(connection, rows):
-    '''fast version'''
-    cursor = connection.cursor()
-    cursor.executemany(
+            ''', rows)
+        # Images already registered under another name or session
+        cursor.execute(
+            '''
+            SELECT r.name, i.name
+            FROM register_t AS r
+            JOIN image_t AS i USING(hash)
+            WHERE i.name != r.name
+            OR    i.session != r.session
+            ORDER BY r.name ASC
+            ''')
+        rejected = cursor.fetchall()
+        cursor.execute(
             '''
             INSERT OR IGNORE INTO image_t (
                 name, 
                 hash,
+                fingerprint,
                 session,
                 type,
                 state,
                 meta_changes
-            ) VALUES (
-                :name, 
-                :hash,
-                :session, 
-                :type,
-                :state,
-                :changes
             )
-            ''', rows)
-    connection.commit()
-    log.info("Registered %d / %d images in database", cursor.rowcount, len(rows))
+            SELECT name, hash, fingerprint, session, type, state, changes
+            FROM register_t
+            ORDER BY name ASC
+            ''')
+        count = cursor.rowcount
+        cursor.execute("DROP TABLE register_t")
+    except sqlite3.Error:
+        connection.rollback()
+        raise
+    else:
+        connection.commit()
+    log.info("Registered %d / %d images in database", count, len(rows))
+    return rejected
 
 
 def candidates(connection, work_dir, filt, session):
@@ -315,7 +629,7 @@ def candidates(connection, work_dir, filt, session):
     # This query will have far less elements to fetch
     # This will introduce duplicates which will be rejected by the INSERT or IGNORE
     # when inserting new images
-    cursor.execute("SELECT name, hash FROM candidate_t")
+    cursor.execute("SELECT name, hash, fingerprint FROM candidate_t")
     result = cursor.fetchall()
     if result:
         #names_to_add, = zip(*result)
@@ -349,38 +663,25 @@ def register_delete_images(connection, rows):
             DELETE FROM image_t 
             WHERE hash  == :hash
             ''', rows)
-    connection.commit()
     log.info("Deleted %d / %d images from database", cursor.rowcount, len(rows))
-
-
-def register_slow(connection, work_dir, names_list, session):
-    counter = LogCounter(N_COUNT)
-    for name, hsh in names_list:
-        file_path = os.path.join(work_dir, name)
-        row  = {'name': name, 'hash': hsh, 'session': session, 
-        'state': REGISTERED, 'type': UNKNOWN, 'changes': CAMERA_CHANGES + OBSERVER_CHANGES}
-        try:
-            register_insert_image(connection, row)
-        except sqlite3.IntegrityError as e:
-            connection.rollback()
-            name2, = find_by_hash(connection, row['hash'])
-            log.warning("Duplicate => %s EQUALS %s", file_path, name2)
-        else:
-            counter.tick("Registered %03d images in database (slow method)",level=logging.DEBUG)
-            log.debug("%s registered in database", row['name'])
-    counter.end("Registered %03d images in database (slow method)")
+    side_stats_delete(connection, rows)
+    connection.commit()
 
 
 def register_fast(connection, work_dir, names_list, session):
     rows = []
-    for name, hsh in names_list:
+    for name, hsh, fingerprint in names_list:
         file_path = os.path.join(work_dir, name)
         row  = {'name': name, 'session': session, 
         'state': REGISTERED, 'type': UNKNOWN, 'changes': CAMERA_CHANGES + OBSERVER_CHANGES}
         row['hash'] = hsh
+        row['fingerprint'] = fingerprint
         rows.append(row)
         log.debug("Image %s being registered in database", row['name'])
-    register_insert_images(connection, rows)
+    rejected = register_insert_images(connection, rows)
+    for name, name2 in rejected:
+        log.warning("Duplicate => %s EQUALS %s", os.path.join(work_dir, name), name2)
+    return rejected
     
 
 def register_unregister(connection, names_list, session):
@@ -419,11 +720,9 @@ def register_log_kept(connection, session):
             log.info("And %d more images being kept in database", count - ARBITRARY_NUMBER)
 
 
-# Tal como esta montado ahora candidates(), es imposible introducir una imagen
-# duplicada porque se cumprueba primero que su hash no esta ya en la BD
-# Y por tanbo register_low() es innecesario.
-# Sin embargo candidates() podría enlentecerse al aumentar el número de imagenes de la BD
-# Por lo que al final register_slow() podría ser una opcion
+# candidates() no comprueba si el hash ya esta en la BD porque seria lento
+# con muchas imagenes. register_insert_images() inserta todo en una sola
+# transaccion con INSERT OR IGNORE y devuelve los duplicados rechazados.
 def do_register(connection, work_dir, filt, session):
     register_deleted = False
     names_to_add, names_to_del = candidates(connection, work_dir, filt, session)
@@ -497,6 +796,61 @@ def do_classify(connection, session, work_dir, options):
         log.info("No image type classification is needed")
 
 
+# ----------
+# EXIF Cache
+# ----------
+
+# Los metadatos EXIF de un fichero nunca cambian, asi que se guardan por hash
+# y no se vuelven a leer del disco en sucesivos reprocesados.
+def exif_session_lookup(connection, session):
+    '''Cached metadata of all images in a session, by hash'''
+    row = {'session': session}
+    cursor = connection.cursor()
+    cursor.execute(
+        '''
+        SELECT e.hash, e.model, e.iso, e.tstamp, e.night, e.exptime, e.focal_length, e.f_number, e.bias
+        FROM exif_t AS e
+        JOIN image_t AS i USING(hash)
+        WHERE i.session = :session
+        ''', row)
+    keys = ('model', 'iso', 'tstamp', 'night', 'exptime', 'focal_length', 'f_number', 'bias')
+    return { item[0]: dict(zip(keys, item[1:])) for item in cursor }
+
+
+def exif_update_db(connection, rows):
+    cursor = connection.cursor()
+    cursor.executemany(
+        '''
+        INSERT OR IGNORE INTO exif_t (hash, model, iso, tstamp, night, exptime, focal_length, f_number, bias)
+        VALUES (:hash, :model, :iso, :tstamp, :night, :exptime, :focal_length, :f_number, :bias)
+        ''', rows)
+
+
+def exif_header(file_path):
+    try:
+        return header_exif(file_path)
+    except OSError:
+        return None
+
+
+def exif_batch_metadata(file_paths, workers=DEF_HASH_WORKERS):
+    '''
+    Metadata of images by file path, each header read and parsed only once.
+    Images the fast EXIF reader cannot handle are looked up with exiftool
+    in batches rather than one by one by each image later on
+    '''
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        headers = list(executor.map(exif_header, file_paths))
+    exiftool_prefetch([ file_path for file_path, header in zip(file_paths, headers) if header is None ])
+    result = {}
+    for file_path, header in zip(file_paths, headers):
+        try:
+            result[file_path] = CameraImage(file_path, None).loadEXIF(header)
+        except Exception as e:
+            log.debug("%s: EXIF metadata not found => %s", os.path.basename(file_path), e)
+    return result
+
+
 # -----------
 # Image Stats
 # -----------
@@ -524,14 +878,52 @@ def stats_update_db(connection, rows):
             vari_signal_R1  = :vari_signal_R1,
             vari_signal_G2  = :vari_signal_G2,
             vari_signal_G3  = :vari_signal_G3,
-            vari_signal_B4  = :vari_signal_B4 
+            vari_signal_B4  = :vari_signal_B4,
+            dark_key        = :dark_key
         WHERE hash = :hash
         ''', rows)
-    connection.commit()
 
 
-def stats_session_iterable(connection, session):
-    row = {'session': session, 'state': STATS_COMPUTED}
+def extra_stats_update_db(connection, rows):
+    cursor = connection.cursor()
+    cursor.executemany(
+        '''
+        INSERT OR REPLACE INTO extra_stats_t (hash, channel, statistic, value)
+        VALUES (:hash, :channel, :statistic, :value)
+        ''', rows)
+
+
+def roi_stats_update_db(connection, rows):
+    cursor = connection.cursor()
+    cursor.executemany(
+        '''
+        INSERT OR REPLACE INTO roi_stats_t (
+            hash, roi_name, roi,
+            aver_R1, vari_R1, aver_G2, vari_G2, aver_G3, vari_G3, aver_B4, vari_B4
+        ) VALUES (
+            :hash, :roi_name, :roi,
+            :aver_R1, :vari_R1, :aver_G2, :vari_G2, :aver_G3, :vari_G3, :aver_B4, :vari_B4
+        )
+        ''', rows)
+
+
+def side_stats_delete(connection, rows):
+    '''Delete statistics kept outside image_t for the given images'''
+    cursor = connection.cursor()
+    cursor.executemany(
+            '''
+            DELETE FROM extra_stats_t 
+            WHERE hash  == :hash
+            ''', rows)
+    cursor.executemany(
+            '''
+            DELETE FROM roi_stats_t 
+            WHERE hash  == :hash
+            ''', rows)
+
+
+def stats_session_iterable(connection, session, frame_type):
+    row = {'session': session, 'state': STATS_COMPUTED, 'type': frame_type}
     cursor = connection.cursor()
     cursor.execute(
         '''
@@ -539,11 +931,31 @@ def stats_session_iterable(connection, session):
         FROM image_t
         WHERE state < :state
         AND session = :session
+        AND type = :type
         ORDER BY name ASC
         ''', row)
     return cursor
 
 
+def stats_dark_reset(connection, session, key):
+    '''LIGHT images measured with another master dark, or none, are to be measured again'''
+    row = {'session': session, 'type': LIGHT_FRAME, 'state': STATS_COMPUTED, 'new_state': REGISTERED, 'key': key}
+    cursor = connection.cursor()
+    cursor.execute(
+        '''
+        UPDATE image_t
+        SET state = :new_state
+        WHERE session = :session
+        AND type = :type
+        AND state >= :state
+        AND dark_key IS NOT :key
+        ''', row)
+    connection.commit()
+    if cursor.rowcount > 0:
+        log.info("%d LIGHT images to be measured again for the current master dark", cursor.rowcount)
+    return cursor.rowcount
+
+
 def stats_unregister(connection, rows):
     '''Unregister an image who gave an exception reaing the pixel data'''
     cursor = connection.cursor()
@@ -552,53 +964,349 @@ def stats_unregister(connection, rows):
             DELETE FROM image_t 
             WHERE hash  == :hash
             ''', rows)
-    connection.commit()
     log.info("Deleted %d / %d images from database", cursor.rowcount, len(rows))
+    side_stats_delete(connection, rows)
     
 
-def do_stats(connection, session, work_dir, options):
+def stats_plan(options):
+    '''What to measure on each image, as a picklable dictionary'''
+    plan = {'roi': options.roi, 'extra': None, 'regions': None, 'pixels': None, 'darks': None, 'dark': None}
+    if options.statistics:
+        plan['extra'] = (options.statistics, options.percentiles, options.clip_sigma)
+    if options.regions:
+        plan['regions'] = (options.regions, options.rings, options.sectors)
+    if options.pixel_cache > 0:
+        plan['pixels'] = (AZOTEA_PIX_DIR, options.pixel_cache*1024*1024)
+    # DARK frames keep their decoded pixels at least until the master dark is built
+    plan['darks'] = plan['pixels'] or (AZOTEA_PIX_DIR, DEF_DARK_PIXELS_SIZE*1024*1024)
+    return plan
+
+
+def pixel_cache(settings):
+    '''Decoded pixels cache shared by all images measured in this process'''
+    if settings not in _pixel_caches:
+        _pixel_caches[settings] = PixelCache(*settings)
+    return _pixel_caches[settings]
+
+
+def stats_measure(file_path, hsh, camera_cache, plan, metadata=None, buffer=None):
+    '''Decode and measure a single image, using cached EXIF metadata and contents if given.
+    The hash is the one computed or cached at registration, so the file is not hashed again.
+    Without contents, only the EXIF header and the RAW decoder read the file, if they need to.
+    LIGHT frames are measured after substracting the plan master dark (path, key), if any.
+    Returns the row to update or None if the image is to be unregistered'''
+    name = os.path.basename(file_path)
+    frame_type = classification_algorithm2(name, file_path, None)['type']
+    pixels = pixel_cache(plan['pixels']) if plan['pixels'] else None
+    if pixels is None and plan.get('darks') and frame_type == DARK_FRAME:
+        pixels = pixel_cache(plan['darks'])
+    image = CameraImage(file_path, camera_cache, buffer, pixels, hsh)
+    image.setROI(plan['roi'])
+    if metadata is None:
+        metadata = image.loadEXIF()
+    else:
+        image.setMetadata(metadata)
+    try:
+        image.read()
+    except Exception as e:
+        log.warn("%s: Error while reading pixels", name)
+        return None
+    dark_key = None
+    if plan.get('dark') and frame_type == LIGHT_FRAME:
+        dark_path, dark_key = plan['dark']
+        image.subtractDark(master_dark_load(dark_path))
+    row = image.stats()
+    row['hash']         = hsh
+    row['dark_key']     = dark_key
+    row['state']        = STATS_COMPUTED
+    row['model']        = metadata['model']
+    row['iso']          = metadata['iso']
+    row['tstamp']       = metadata['tstamp']
+    row['night']        = metadata['night']
+    row['exptime']      = metadata['exptime']
+    row['bias']         = metadata['bias']
+    row['focal_length'] = metadata['focal_length']
+    row['f_number']     = metadata['f_number']
+    if plan['extra']:
+        statistics, percentiles, clip_sigma = plan['extra']
+        row['extra'] = image.extra_stats(statistics, percentiles, clip_sigma)
+        for item in row['extra']:
+            item['hash'] = hsh
+    if plan['regions']:
+        regions, rings, sectors = plan['regions']
+        row['regions'] = image.named_stats(regions, rings, sectors)
+        for item in row['regions']:
+            item['hash'] = hsh
+    return row
+
+
+# Each worker process keeps its own camera configuration cache
+_worker_camera_cache = None
+
+class StatsLogForwarder(logging.Handler):
+    '''Hands worker log records over to the parent process loggers'''
+    def emit(self, record):
+        logging.getLogger(record.name).handle(record)
+
+
+def stats_worker_init(camera, log_queue=None, level=logging.INFO):
+    '''
+    Worker processes do not inherit the logging configuration:
+    their records are queued to the parent, which formats and writes them
+    '''
+    global _worker_camera_cache
+    if log_queue is not None:
+        for handler in list(log.handlers):
+            log.removeHandler(handler)
+        log.addHandler(logging.handlers.QueueHandler(log_queue))
+        log.setLevel(level)
+        log.propagate = False
+    _worker_camera_cache = CameraCache(camera)
+
+
+def stats_mp_context():
+    '''
+    Workers must not be forked: rawpy (OpenMP) may deadlock in forked children
+    and they would share the parent exiftool session pipe
+    '''
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def stats_task(task, camera_cache):
+    '''
+    Returns (hash, stats_measure() result) for a task.
+    Tasks without a hash are new images: they are read once, and the same
+    contents feed the hasher, the EXIF reader and the RAW decoder
+    '''
+    file_path, hsh, plan, metadata = task
+    if hsh is None:
+        buffer, hsh = ingest(file_path)
+        return hsh, stats_measure(file_path, hsh, camera_cache, plan, metadata, buffer)
+    return hsh, stats_measure(file_path, hsh, camera_cache, plan, metadata)
+
+
+def stats_maxrss():
+    '''Peak resident memory of the calling process in KB (Linux), 0 if unknown'''
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def stats_worker(task_fn, task):
+    result = task_fn(task, _worker_camera_cache)
+    return result, CameraImage.ExiftoolFixed, stats_maxrss()
+
+
+def stats_estimate(file_path):
+    '''Estimated memory in bytes to measure an image: file contents plus 16 bit decoded pixels'''
+    size = os.path.getsize(file_path)
+    try:
+        dimensions = raw_dimensions(file_path)
+    except Exception:
+        dimensions = None
+    # EXIF dimensions may be those of an embedded thumbnail (NEF),
+    # while a RAW file never decodes to fewer bytes than it takes on disk
+    decoded = 2 * size
+    if dimensions:
+        decoded = max(2 * dimensions[0] * dimensions[1], decoded)
+    return size + decoded
+
+
+def stats_peak_memory(scheduled, workers=None):
+    '''
+    Logs peak memory usage of the statistics stage.
+    workers is the largest peak reported by the workers themselves,
+    as RUSAGE_CHILDREN does not see forkserver grandchildren
+    '''
+    if scheduled:
+        log.info("Peak scheduled memory: %d MB", scheduled // (1024*1024))
+    if resource is None:
+        return
+    # ru_maxrss is given in KB on Linux
+    main = stats_maxrss() // 1024
+    if workers is None:
+        log.info("Peak resident memory: %d MB", main)
+    else:
+        log.info("Peak resident memory: %d MB main process, %d MB largest worker", main, workers // 1024)
+
+
+def stats_results(tasks, options, task_fn=stats_task):
+    '''
+    Yields (task, task_fn(task, camera_cache)) in task order, using a process pool if asked to.
+    Tasks start with the image file path. Images are only handed to the pool while their
+    estimated memory fits in the budget. Nothing is started if there are no tasks.
+    '''
+    tasks = iter(tasks)
+    first = next(tasks, None)
+    if first is None:
+        return
+    tasks = itertools.chain([first], tasks)
+    if options.jobs < 2:
+        camera_cache = CameraCache(options.camera)
+        for task in tasks:
+            yield task, task_fn(task, camera_cache)
+        stats_peak_memory(0)
+        return
+    budget = options.memory_budget * 1024 * 1024
+    if budget:
+        log.info("Computing image statistics with %d processes within %d MB", options.jobs, options.memory_budget)
+    else:
+        log.info("Computing image statistics with %d processes", options.jobs)
+    context   = stats_mp_context()
+    log_queue = context.Queue()
+    listener  = logging.handlers.QueueListener(log_queue, StatsLogForwarder())
+    listener.start()
+    try:
+        for item in stats_pool(tasks, options, task_fn, context, log_queue):
+            yield item
+    finally:
+        listener.stop()
+
+
+def stats_pool(tasks, options, task_fn, context, log_queue):
+    '''Process pool part of stats_results()'''
+    budget   = options.memory_budget * 1024 * 1024
+    pending  = collections.deque()
+    inflight = 0
+    peak     = 0
+    maxrss   = 0
+    tasks    = iter(tasks)
+    task     = next(tasks, None)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=options.jobs, mp_context=context,
+            initializer=stats_worker_init, initargs=(options.camera, log_queue, log.getEffectiveLevel())) as executor:
+        while task is not None or pending:
+            # Admit at least one image, even if it alone exceeds the budget
+            while task is not None and len(pending) < 2 * options.jobs:
+                estimate = stats_estimate(task[0]) if budget else 0
+                if pending and inflight + estimate > budget:
+                    break
+                pending.append((task, executor.submit(stats_worker, task_fn, task), estimate))
+                inflight += estimate
+                peak = max(peak, inflight)
+                task = next(tasks, None)
+            task_done, future, estimate = pending.popleft()
+            result, exiftool_fixed, worker_maxrss = future.result()
+            inflight -= estimate
+            maxrss    = max(maxrss, worker_maxrss)
+            CameraImage.ExiftoolFixed = CameraImage.ExiftoolFixed or exiftool_fixed
+            yield task_done, result
+    stats_peak_memory(peak, maxrss)
+
+
+def ingest_files(file_paths, options, measured):
+    '''
+    Hashes of new images, measured in the same read.
+    Their statistics are kept in measured, by hash, for the stats step
+    '''
+    log.info("Reading %d new images once for both hashes and statistics", len(file_paths))
+    plan   = stats_plan(options)
+    hashes = {}
+    # DARK frames go first, so that LIGHT frames are measured against their master dark
+    darks  = set(path for path in file_paths if classification_algorithm2(os.path.basename(path), path, options)['type'] == DARK_FRAME)
+    lights = [ path for path in file_paths if path not in darks ]
+    darks  = [ path for path in file_paths if path in darks ]
+    frames = []
+    for task, (hsh, row) in stats_results([ (file_path, None, plan, None) for file_path in darks ], options):
+        hashes[task[0]] = hsh
+        if row is not None:
+            measured[hsh] = row
+            frames.append((task[0], row, hsh))
+    if frames:
+        key = master_dark_key(hsh for file_path, row, hsh in frames)
+        try:
+            plan['dark'] = (dark_build_key(frames, key, plan, options), key)
+        except (OSError, ValueError) as e:
+            log.error("Could not build pixel level master dark => %s", e)
+    for task, (hsh, row) in stats_results([ (file_path, None, plan, None) for file_path in lights ], options):
+        hashes[task[0]] = hsh
+        if row is not None:
+            measured[hsh] = row
+    return [ hashes[file_path] for file_path in file_paths ]
+
+
+def stats_flush(connection, rows, rows_to_unregister):
+    '''
+    Commits a batch of results, in a single transaction,
+    so that an interrupted run can be resumed
+    '''
+    try:
+        if rows_to_unregister:
+            stats_unregister(connection, rows_to_unregister)
+        if rows:
+            stats_update_db(connection, rows)
+            exif_update_db(connection, rows)
+            extra_rows = [ item for row in rows for item in row.get('extra', []) ]
+            if extra_rows:
+                extra_stats_update_db(connection, extra_rows)
+            region_rows = [ item for row in rows for item in row.get('regions', []) ]
+            if region_rows:
+                roi_stats_update_db(connection, region_rows)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    if rows:
+        log.debug("Committed statistics for %d images", len(rows))
+
+
+def do_stats(connection, session, work_dir, options, measured=None, frame_type=LIGHT_FRAME, dark=None, resumed=False):
+    '''
+    Statistics of images of a given type, with the master dark (path, key) substracted if given.
+    resumed tells that a previous run on this session was interrupted.
+    Returns whether any was computed and how many images could not be read and were unregistered
+    '''
     stats_computed_flag = False
-    camera_cache = CameraCache(options.camera)
+    unregistered = 0
     rows = []
     rows_to_unregister = []
     counter = LogCounter(N_COUNT)
     CameraImage.ExiftoolFixed = False
-    log.debug("Computing image statistics")
-    for name, hsh in stats_session_iterable(connection, session):
-        file_path = os.path.join(work_dir, name)
-        image = CameraImage(file_path, camera_cache)
-        image.setROI(options.roi)
-        counter.tick("Statistics for %03d images done")
-        metadata = image.loadEXIF()
-        try:
-            image.read()
-        except Exception as e:
-            log.warn("%s: Error while reading pixels", name)
-            rows_to_unregister.append({'name': name, 'hash': hsh, 'session':session})
+    log.debug("Computing %s image statistics", frame_type)
+    plan  = stats_plan(options)
+    plan['dark'] = dark
+    key   = dark[1] if dark else None
+    cache = exif_session_lookup(connection, session)
+    tasks = [ (os.path.join(work_dir, name), hsh, plan, cache.get(hsh)) for name, hsh in stats_session_iterable(connection, session, frame_type) ]
+    skipped = session_processed(connection, session)
+    if tasks and skipped and resumed:
+        log.info("Resuming session: skipping %d images with statistics already computed", skipped)
+    if measured:
+        # Images already measured, against the same master dark, when they were read to be hashed or placed
+        done = set(task[1] for task in tasks if task[1] in measured and measured[task[1]].get('dark_key') == key)
+        premeasured = [ measured[hsh] for hsh in done ]
+        tasks = [ task for task in tasks if task[1] not in done ]
+        for row in premeasured:
+            counter.tick("Statistics for %03d " + frame_type + " images done")
+            stats_computed_flag = True
+        stats_flush(connection, premeasured, [])
+    fetched = exif_batch_metadata([ task[0] for task in tasks if task[3] is None ], options.hash_workers)
+    if fetched:
+        tasks = [ (file_path, hsh, plan, metadata or fetched.get(file_path)) for file_path, hsh, plan, metadata in tasks ]
+    last_commit = time.monotonic()
+    # The main process is the only database writer
+    for (file_path, hsh, plan, metadata), (_, row) in stats_results(tasks, options):
+        counter.tick("Statistics for %03d " + frame_type + " images done")
+        if row is None:
+            rows_to_unregister.append({'name': os.path.basename(file_path), 'hash': hsh, 'session':session})
+            unregistered += 1
         else:
-            row = image.stats()
-            row['hash']         = hsh
-            row['state']        = STATS_COMPUTED
-            row['model']        = metadata['model']
-            row['iso']          = metadata['iso']
-            row['tstamp']       = metadata['tstamp']
-            row['night']        = metadata['night']
-            row['exptime']      = metadata['exptime']
-            row['bias']         = metadata['bias']
-            row['focal_length'] = metadata['focal_length']
-            row['f_number']     = metadata['f_number']
             rows.append(row)
-    if rows_to_unregister:
-        stats_unregister(connection, rows_to_unregister)
-    if rows:
-        counter.end("Statistics for %03d images done")
-        stats_update_db(connection, rows)
-        stats_computed_flag = True
+            stats_computed_flag = True
+        if (len(rows) + len(rows_to_unregister) >= options.batch_size or 
+            time.monotonic() - last_commit >= options.batch_interval):
+            stats_flush(connection, rows, rows_to_unregister)
+            rows, rows_to_unregister = [], []
+            last_commit = time.monotonic()
+    stats_flush(connection, rows, rows_to_unregister)
+    if stats_computed_flag:
+        counter.end("Statistics for %03d " + frame_type + " images done")
     else:
-        log.info("No image statistics to be computed")
+        log.info("No %s image statistics to be computed", frame_type)
     if CameraImage.ExiftoolFixed:
         log.warning("exiftool was used to read EXIF metadata")
-    return stats_computed_flag
+    return stats_computed_flag, unregistered
 
 
 # ---------------
@@ -690,6 +1398,88 @@ def do_metadata(connection, session, options):
     return metadata_updated_flag
 
 
+# -----------------------
+# Pixel level master dark
+# -----------------------
+
+def dark_build_iterable(connection, session):
+    row = {'type': DARK_FRAME, 'state': STATS_COMPUTED, 'session': session}
+    cursor = connection.cursor()
+    cursor.execute(
+        '''
+        SELECT name, hash
+        FROM image_t
+        WHERE session = :session
+        AND   type    = :type
+        AND   state  >= :state
+        ORDER BY name
+        ''', row)
+    return cursor.fetchall()
+
+
+def dark_build_key(frames, key, plan, options):
+    '''
+    Master dark of DARK frames given as (file path, metadata or None, hash),
+    stacked from their decoded pixels if still cached. Returns its path
+    '''
+    pixels = pixel_cache(plan['darks'])
+    path = master_dark_path(key)
+    if os.path.exists(path):
+        log.info("Reusing master dark %s", os.path.basename(path))
+    else:
+        path = master_dark_build(frames, CameraCache(options.camera), key, pixels)
+    if not plan['pixels']:
+        # Decoded DARK frames were only kept for the master dark
+        for file_path, metadata, hsh in frames:
+            pixels.discard(hsh)
+    return path
+
+
+# Los master dark a nivel de pixel se guardan en disco por conjunto de DARKs
+# y se reconstruyen solo cuando cambia el conjunto de DARKs de la sesion.
+def do_dark_build(connection, session, work_dir, options):
+    '''Pixel level master dark of a session as (path, key), or None if it has no DARK frames'''
+    darks = dark_build_iterable(connection, session)
+    if not darks:
+        return None
+    key    = master_dark_key(hsh for name, hsh in darks)
+    cache  = exif_session_lookup(connection, session)
+    frames = [ (os.path.join(work_dir, name), cache.get(hsh), hsh) for name, hsh in darks ]
+    if not os.path.exists(master_dark_path(key)):
+        fetched = exif_batch_metadata([ file_path for file_path, metadata, hsh in frames if metadata is None ])
+        frames = [ (file_path, metadata or fetched.get(file_path), hsh) for file_path, metadata, hsh in frames ]
+    return dark_build_key(frames, key, stats_plan(options), options), key
+
+
+def dark_prune(connection):
+    '''Remove master darks no longer substracted from any image'''
+    cursor = connection.cursor()
+    cursor.execute("SELECT DISTINCT dark_key FROM image_t WHERE dark_key IS NOT NULL")
+    master_dark_prune(set(key for key, in cursor))
+
+
+def master_dark_pixel_update(connection, session, path):
+    row = {'session': session}
+    cursor = connection.cursor()
+    cursor.execute("SELECT roi FROM master_dark_t WHERE session = :session", row)
+    result = cursor.fetchone()
+    roi = ROI.strproi(result[0]) if result and result[0] else None
+    if roi is None:
+        return
+    row['aver_R1'], row['aver_G2'], row['aver_G3'], row['aver_B4'] = master_dark_roi_stats(path, roi)
+    cursor.execute(
+        '''
+        UPDATE master_dark_t
+        SET
+            aver_R1 = :aver_R1,
+            aver_G2 = :aver_G2,
+            aver_G3 = :aver_G3,
+            aver_B4 = :aver_B4
+        WHERE session = :session
+        ''', row)
+    connection.commit()
+
+
 # -----------------------------
 # Image Apply Dark Substraction
 # -----------------------------
@@ -811,12 +1601,35 @@ def dark_update_columns(connection, session):
         WHERE session = :session
         AND   state BETWEEN :state AND :new_state
         AND   type  = :type
+        AND   dark_key IS NULL
+        ''',row)
+    # The pixel level master dark was already substracted when measuring
+    cursor.execute(
+        '''
+        UPDATE image_t
+        SET
+            state        = :new_state,
+            aver_dark_R1 = 0.0,
+            aver_dark_G2 = 0.0,
+            aver_dark_G3 = 0.0,
+            aver_dark_B4 = 0.0,
+            vari_dark_R1 = 0.0,
+            vari_dark_G2 = 0.0,
+            vari_dark_G3 = 0.0,
+            vari_dark_B4 = 0.0
+        WHERE session = :session
+        AND   state BETWEEN :state AND :new_state
+        AND   type  = :type
+        AND   dark_key IS NOT NULL
         ''',row)
     connection.commit()
 
 
-def do_apply_dark(connection, session, options):
+def do_apply_dark(connection, session, options, master=None):
+    '''Master is the pixel level master dark (path, key) built for the current set of DARK frames, if any'''
     master_dark_db_update_session(connection, session)
+    if master:
+        master_dark_pixel_update(connection, session, master[0])
     if master_dark_for(connection, session):
         log.info("Applying dark substraction to current working directory")
         dark_update_columns(connection, session)
@@ -1451,20 +2264,34 @@ def image_export(connection, options):
     do_export_all(connection, options)
     
 
-def do_image_reduce(connection, options):
+def do_image_reduce(connection, options, measured=None):
     log.info("#"*48)
     tmp  = os.path.basename(options.work_dir)
     if tmp == '':
         options.work_dir = options.work_dir[:-1]
     log.info("Working Directory: %s", options.work_dir)
+    manifest = manifest_compute(options.work_dir, options.config, options.camera)
+    if not (options.reset or options.force_csv) and manifest_unchanged(connection, manifest):
+        log.info("Skipping unchanged working directory")
+        return False
     file_options = load_config_file(options.config)
     options      = merge_options(options, file_options)
-    session = work_dir_to_session(connection, options.work_dir, options.filter)
+    if measured is None:
+        # New images are measured as they are hashed, reading them only once
+        measured = {}
+        hasher = functools.partial(ingest_files, options=options, measured=measured)
+    else:
+        hasher = None
+    session = work_dir_to_session(connection, options.work_dir, options.filter, options.hash_workers, hasher)
     if session is None:
-        session = int(datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S"))
+        session = session_new()
+        resumed = False
         log.info("Start with new reduction session %d", session)
     else:
+        resumed = session_interrupted(connection, session)
         log.info("Start with existing reduction session %d", session)
+    # Until this run completes, so that an interruption can be told next time
+    manifest_delete(connection, options.work_dir)
 
     # Step 1: registering
     register_deleted = do_register(connection, options.work_dir, options.filter, session)
@@ -1472,28 +2299,48 @@ def do_image_reduce(connection, options):
     if options.reset:
         image_session_state_reset(connection, session)
     
-    # Step 2
+    # Step 2: classification, by name, so that DARK frames are measured first
+    do_classify(connection, session, options.work_dir, options)
+
+    # Step 3: DARK frames statistics
     try:
-        stats_computed = do_stats(connection, session, options.work_dir, options)
-    except MetadataError as e:
+        darks_computed, darks_unread = do_stats(connection, session, options.work_dir, options, measured, DARK_FRAME, resumed=resumed)
+    except (MetadataError, ConfigError) as e:
         log.error(e)
         work_dir_cleanup(connection)
         raise
-    except ConfigError as e:
+
+    # Step 4: dark build
+    # The directory manifest is only updated if every step succeeds
+    completed = True
+    try:
+        master = do_dark_build(connection, session, options.work_dir, options)
+    except (OSError, ValueError) as e:
+        log.error("Could not build pixel level master dark => %s", e)
+        master    = None
+        completed = False
+
+    # Step 5: LIGHT frames statistics, substracting the master dark
+    stats_dark_reset(connection, session, master[1] if master else None)
+    try:
+        lights_computed, lights_unread = do_stats(connection, session, options.work_dir, options, measured, LIGHT_FRAME, master, resumed)
+    except (MetadataError, ConfigError) as e:
         log.error(e)
         work_dir_cleanup(connection)
         raise
+    stats_computed = darks_computed or lights_computed
+    if darks_unread or lights_unread:
+        log.warning("%d images could not be read, %s will be reduced again", darks_unread + lights_unread, options.work_dir)
+        completed = False
 
-    # Step 3
+    # Step 6
     metadata_updated = do_metadata(connection, session, options)
 
-    # Step 4
-    do_classify(connection, session, options.work_dir, options)
-
-    # Step 5
-    do_apply_dark(connection, session, options)
+    # Step 7
+    do_apply_dark(connection, session, options, master)
+    dark_prune(connection)
 
-    # Step 6
+    # Step 8
     if register_deleted or stats_computed or metadata_updated or options.force_csv:
         try:
             do_export_work_dir(connection, session, options.work_dir, options)
@@ -1506,6 +2353,11 @@ def do_image_reduce(connection, options):
 
     # Cleanup session stuff
     work_dir_cleanup(connection)
+    if completed:
+        manifest_update(connection, manifest, session)
+    else:
+        log.info("Work directory manifest not updated, as some step failed")
+    return True
 
 
 def do_image_multidir_reduce(connection, options):
@@ -1521,11 +2373,33 @@ def do_image_multidir_reduce(connection, options):
                 do_image_reduce(connection, options)
             except ConfigError as e:
                 pass
-            time.sleep(1.5)
     else:
         do_image_reduce(connection, options)
 
 
+def dark_build(connection, options):
+    '''
+    Builds the pixel level master dark of an already reduced working directory.
+    Its LIGHT images are measured against it on the next reduction
+    '''
+    file_options = load_config_file(options.config)
+    options      = merge_options(options, file_options)
+    try:
+        session = work_dir_to_session(connection, options.work_dir, options.filter, options.hash_workers)
+    finally:
+        work_dir_cleanup(connection)
+    if session is None:
+        log.error("%s has not been reduced yet", options.work_dir)
+        return
+    master = do_dark_build(connection, session, options.work_dir, options)
+    if master is None:
+        log.info("No DARK frames in session %d", session)
+        return
+    log.info("Master dark for session %d is %s", session, master[0])
+    if stats_dark_reset(connection, session, master[1]):
+        manifest_delete(connection, options.work_dir)
+
+
 def image_reduce(connection, options):
     
     def by_name(item):
@@ -10,13 +10,25 @@
 # System wide imports
 # -------------------
 
-import sys
 import os
 import os.path
 import glob
+import json
+import argparse
+import errno
+import hashlib
 import logging
 import shutil
-import subprocess
+import functools
+import itertools
+import collections
+import concurrent.futures
+
+try:
+	# Unix only
+	import fcntl
+except ImportError:
+	fcntl = None
 
 # ---------------------
 # Third party libraries
@@ -28,8 +40,13 @@ import jdcal
 # local imports
 # -------------
 
-from .camera import CameraImage
-from .utils  import LogCounter
+from .camera     import CameraImage, MetadataError, ConfigError
+from .config     import load_config_file, merge_options
+from .exif       import EXIFTOOL_BATCH, header_exif, exiftool_prefetch
+from .exceptions import MixingCandidates
+from .image      import hash as image_hash, ingest, stats_plan, stats_measure, stats_results, do_image_reduce
+from .image      import hash_cache_stat, hash_cache_update
+from .utils      import LogCounter
 
 # ----------------
 # Module constants
@@ -37,18 +54,36 @@ from .utils  import LogCounter
 
 N_FILES = 50
 
+# Images already placed, kept in the output base directory
+MANIFEST_NAME = '.reorganize.jsonl'
+
+# Suffix of files being placed, renamed when complete
+PARTIAL_SUFFIX = '.part'
+
+# Read size when comparing a truncated destination with its source
+PREFIX_BLOCK_SIZE = 1048576
+
+# Linux ioctl to clone a file in copy-on-write filesystems (btrfs, xfs ...)
+FICLONE = 0x40049409
+
+# errno values telling a zero-copy method is not available for these files
+ZERO_COPY_ERRNOS = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.ENOTSUP, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF)
+
 # -----------------------
 # Module global variables
 # -----------------------
 
 log = logging.getLogger("azotea")
 
+# Hard links were already replaced by copies, warned once per run
+_link_fallback = False
+
 # -----------------------
 # Module global functions
 # -----------------------
 
 def _copyfileobj_patched(fsrc, fdst, length=16*1024*1024):
-    """Patches shutil method to improve big file copy speed on Linux"""
+    """Big buffer copy, used when no zero-copy kernel path is available"""
     while 1:
         buf = fsrc.read(length)
         if not buf:
@@ -56,49 +91,371 @@ def _copyfileobj_patched(fsrc, fdst, length=16*1024*1024):
         fdst.write(buf)
 
 
-shutil.copyfileobj = _copyfileobj_patched
+def _copy_kernel(fsrc, fdst):
+	'''Zero-copy data transfer inside the kernel. Returns False if not possible'''
+	size = os.fstat(fsrc.fileno()).st_size
+	for method in ('copy_file_range', 'sendfile'):
+		function = getattr(os, method, None)
+		if function is None:
+			continue
+		offset = 0
+		try:
+			while offset < size:
+				if method == 'sendfile':
+					n = function(fdst.fileno(), fsrc.fileno(), offset, size - offset)
+				else:
+					n = function(fsrc.fileno(), fdst.fileno(), size - offset, offset, offset)
+				if n == 0:
+					break
+				offset += n
+		except OSError as e:
+			if offset == 0 and e.errno in ZERO_COPY_ERRNOS:
+				continue	# Not supported here, try the next method
+			raise
+		return True
+	return False
+
+
+def _reflink(fsrc, fdst):
+	'''Copy-on-write clone of the whole file. Returns False if not possible'''
+	if fcntl is None:
+		return False
+	try:
+		fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+	except OSError as e:
+		if e.errno in ZERO_COPY_ERRNOS:
+			return False
+		raise
+	return True
+
+
+def temp_path(dst):
+	'''Hidden sibling where a file is built before being renamed into place'''
+	directory, name = os.path.split(dst)
+	return os.path.join(directory, '.' + name + PARTIAL_SUFFIX)
+
+
+def copy_file(src, dst, reflink=False):
+	'''
+	Copy file contents and metadata, avoiding user space buffers when possible.
+	The copy only shows up under its final name once complete
+	'''
+	tmp = temp_path(dst)
+	with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+		if not ((reflink and _reflink(fsrc, fdst)) or _copy_kernel(fsrc, fdst)):
+			_copyfileobj_patched(fsrc, fdst)
+	shutil.copystat(src, tmp)
+	os.replace(tmp, dst)
+
+
+def move_file(src, dst):
+	'''Metadata only rename if in the same filesystem, copy and delete otherwise'''
+	try:
+		os.replace(src, dst)
+	except OSError as e:
+		if e.errno != errno.EXDEV:
+			raise
+		copy_file(src, dst)
+		os.remove(src)
+
+
+def link_file(src, dst, buffer=None):
+	'''Hard link if in the same filesystem, copy otherwise'''
+	global _link_fallback
+	tmp = temp_path(dst)
+	if os.path.lexists(tmp):
+		os.remove(tmp)
+	try:
+		os.link(src, tmp)
+	except OSError as e:
+		if e.errno != errno.EXDEV:
+			raise
+		if not _link_fallback:
+			log.warning("Input and output directories are in different filesystems. Copying instead of hard linking")
+			_link_fallback = True
+		if buffer is not None:
+			write_file(buffer, src, dst)
+		else:
+			copy_file(src, dst)
+		return
+	os.replace(tmp, dst)
+
+
+def write_file(buffer, src, dst):
+	'''Write already read file contents, with the same temp file and rename protocol'''
+	tmp = temp_path(dst)
+	with open(tmp, 'wb') as fdst:
+		fdst.write(buffer)
+	shutil.copystat(src, tmp)
+	os.replace(tmp, dst)
+
+
+def place_file(src, dst, mode, buffer=None):
+	'''
+	Place an image in its output directory according to the reorganization mode.
+	File contents are written from buffer if already in memory
+	'''
+	if buffer is not None and mode in ('copy', 'reflink'):
+		write_file(buffer, src, dst)
+	elif mode == 'hardlink':
+		link_file(src, dst, buffer)
+	elif mode == 'symlink':
+		tmp = temp_path(dst)
+		if os.path.lexists(tmp):
+			os.remove(tmp)
+		os.symlink(os.path.abspath(src), tmp)
+		os.replace(tmp, dst)
+	elif mode == 'move':
+		move_file(src, dst)
+	else:
+		copy_file(src, dst, reflink=(mode == 'reflink'))
+
+
+def same_file(src, dst, verify):
+	'''Whether dst already holds the contents of src'''
+	if os.path.samefile(src, dst):
+		return True
+	if os.path.getsize(src) != os.path.getsize(dst):
+		return False
+	return not verify or image_hash(src) == image_hash(dst)
+
+
+def file_prefix_hash(filepath, size):
+	'''Hash of the first size bytes of a file'''
+	file_hash = hashlib.blake2b(digest_size=32)
+	with open(filepath, 'rb') as f:
+		while size > 0:
+			block = f.read(min(size, PREFIX_BLOCK_SIZE))
+			if not block:
+				break
+			file_hash.update(block)
+			size -= len(block)
+	return file_hash.digest()
+
+
+def truncated_file(src, dst, buffer=None):
+	'''
+	Whether dst is an incomplete copy of src, left by an interrupted placement
+	not done through a temporary file: shorter, with the same leading contents
+	'''
+	size = os.path.getsize(dst)
+	if size >= os.path.getsize(src):
+		return False
+	if buffer is not None:
+		prefix = hashlib.blake2b(buffer[:size], digest_size=32).digest()
+	else:
+		prefix = file_prefix_hash(src, size)
+	return prefix == file_prefix_hash(dst, size)
+
+
+def place_image(src, output_dir, options, buffer=None, hsh=None):
+	'''
+	Place an image unless an identical one is already there.
+	Returns its manifest record or None on a name clash
+	'''
+	name = os.path.basename(src)
+	dst  = os.path.join(output_dir, name)
+	stat = os.stat(src)
+	if hsh is None and options.verify:
+		hsh = image_hash(src)
+	digest = hsh.hex() if hsh is not None else None
+	if not os.path.exists(dst):
+		place_file(src, dst, options.mode, buffer)
+	elif same_file(src, dst, options.verify):
+		log.debug("%s already in place", dst)
+	elif truncated_file(src, dst, buffer):
+		# place_file() overwrites it through a temporary file and a rename
+		log.warning("%s is an incomplete copy of %s, placed again", dst, src)
+		place_file(src, dst, options.mode, buffer)
+	else:
+		log.warning("Name clash: %s differs from %s, not overwritten", dst, src)
+		return None
+	return {'name': name, 'night': os.path.basename(output_dir), 
+		'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': digest}
+
+
+def reduce_task(task, camera_cache):
+	'''
+	Reads an image once to place it, hash it and measure it, in a statistics worker.
+	Task is (input file path, output dir path, placement options, statistics plan).
+	Returns its manifest record, its hash cache row and its statistics row
+	'''
+	src, output_dir, options, plan = task
+	buffer, hsh = ingest(src)
+	record = place_image(src, output_dir, options, buffer, hsh)
+	if record is None:
+		return None, None, None
+	dst = os.path.join(output_dir, record['name'])
+	cache_row = hash_cache_stat([dst])[0]
+	cache_row['hash'] = hsh
+	row = stats_measure(dst, hsh, camera_cache, plan, buffer=buffer)
+	return record, cache_row, row
+
+
+# Manifest of images already placed in the output base directory, one JSON
+# record per line, so that an interrupted reorganization resumes where it left.
+
+def manifest_load(output_dir):
+	manifest = {}
+	path = os.path.join(output_dir, MANIFEST_NAME)
+	if os.path.exists(path):
+		with open(path) as f:
+			for line in f:
+				try:
+					record = json.loads(line)
+				except ValueError:
+					continue	# Last line truncated by an interruption
+				manifest[record['name']] = record
+	return manifest
+
+
+def manifest_done(options, manifest, input_file_path):
+	'''Output directory of an image already placed, or None'''
+	record = manifest.get(os.path.basename(input_file_path))
+	if record is None:
+		return None
+	stat = os.stat(input_file_path)
+	if record['size'] != stat.st_size or record['mtime_ns'] != stat.st_mtime_ns:
+		return None
+	output_dir = os.path.join(options.output_dir, record['night'])
+	dst = os.path.join(output_dir, record['name'])
+	try:
+		if os.path.getsize(dst) != record['size']:
+			return None
+	except OSError:
+		return None
+	return output_dir
 
 
 def dir_name(jd2000, mjd):
 	year, month, day, fraction = jdcal.jd2gcal(jd2000, mjd)
 	return "{0:04d}-{1:02d}-{2:02d}".format(year, month, day)
 
-def scan_images(options):
-	output_dir_set = set()
-	image_list = []
+def scan_image(options, manifest, input_file_path, header=None):
+	output_dir = manifest_done(options, manifest, input_file_path)
+	if output_dir is not None:
+		return input_file_path, output_dir, True
+	image = CameraImage(input_file_path, options)
+	image.loadEXIF(header)
+	jd2000, mjd = image.getJulianDate()
+	mjd -= 0.5	# Take it 12 hours before and make sure it is the same YYYY-MM-DD
+	date_string = dir_name(jd2000, mjd)
+	return input_file_path, os.path.join(options.output_dir, date_string), False
+
+
+def scan_header(options, manifest, input_file_path):
+	'''
+	(EXIF read by the fast header reader or None, whether exiftool is needed)
+	for an image still to be placed. Images already placed are not read
+	'''
+	try:
+		if manifest_done(options, manifest, input_file_path) is not None:
+			return None, False
+		header = header_exif(input_file_path)
+	except OSError:
+		return None, False
+	return header, header is None
+
+
+def scan_images(options, manifest):
+	'''
+	Yields (input file path, output dir path, already placed) in directory order
+	while EXIF is read concurrently. Images in the manifest are not read at all.
+	Images needing exiftool are looked up in batches, one chunk of files at a time
+	'''
 	counter = LogCounter(N_FILES)
 	filepath_iterable = glob.iglob(os.path.join(options.input_dir, '*'))
-	for input_file_path in filepath_iterable:
-		image = CameraImage(input_file_path, options)
-		image.loadEXIF()
-		jd2000, mjd = image.getJulianDate()
-		mjd -= 0.5	# Take it 12 hours before and make sure it is the same YYYY-MM-DD
-		date_string = dir_name(jd2000, mjd)
-		output_dir_path = os.path.join(options.output_dir, date_string)
-		output_dir_set.add(output_dir_path)
-		image_list.append((input_file_path, output_dir_path))
-		counter.tick("Read %d images")
+	with concurrent.futures.ThreadPoolExecutor(max_workers=options.workers) as executor:
+		while True:
+			chunk = list(itertools.islice(filepath_iterable, EXIFTOOL_BATCH))
+			if not chunk:
+				break
+			headers, needed = zip(*executor.map(functools.partial(scan_header, options, manifest), chunk))
+			exiftool_prefetch([ path for path, flag in zip(chunk, needed) if flag ])
+			for item in executor.map(functools.partial(scan_image, options, manifest), chunk, headers):
+				counter.tick("Read %d images")
+				yield item
 	counter.end("Read %d images")
-	return output_dir_set, image_list
 
 
-def create_dest_directories(output_dir_set):
-	log.info("creating %d output directories", len(output_dir_set))
-	for directory in output_dir_set:
-		if not os.path.isdir(directory):
-			os.makedirs(directory)
+def create_dest_directory(directory):
+	if not os.path.isdir(directory):
+		log.info("creating output directory %s", directory)
+		os.makedirs(directory, exist_ok=True)
 
 
-def copy_files(image_list):
-	log.info("copying images to output directories")
+def copy_files(image_iterable, options, fused=None):
+	'''
+	Place images in output directories as soon as they are scanned, several files at a time.
+	In fused mode, images are also hashed and measured from the same read, by the
+	statistics processes (--jobs) within their memory budget (--memory-budget)
+	'''
+	log.info("placing images in output directories (%s mode)", options.mode)
+	output_dir_set = set()
 	counter = LogCounter(N_FILES)
-	for item in image_list:
-		if sys.platform == 'win32':
-			subprocess.call("xcopy",item[0], item[1])
+	skipped = 0
+	pending = collections.deque()
+
+	def to_place():
+		nonlocal skipped
+		for input_file_path, output_dir, done in image_iterable:
+			output_dir_set.add(output_dir)
+			if done:
+				skipped += 1
+				continue
+			create_dest_directory(output_dir)
+			yield input_file_path, output_dir
+
+	def placed(record):
+		if record is not None:
+			json.dump(record, manifest_file)
+			manifest_file.write('\n')
+			manifest_file.flush()
+		counter.tick("Placed %d images")
+
+	create_dest_directory(options.output_dir)
+	with open(os.path.join(options.output_dir, MANIFEST_NAME), 'a') as manifest_file:
+		if fused is None:
+			with concurrent.futures.ThreadPoolExecutor(max_workers=options.workers) as executor:
+				for input_file_path, output_dir in to_place():
+					pending.append(executor.submit(place_image, input_file_path, output_dir, options))
+					while len(pending) > 2 * options.workers or (pending and pending[0].done()):
+						placed(pending.popleft().result())
+				while pending:
+					placed(pending.popleft().result())
 		else:
-			shutil.copy2(item[0], item[1])
-		counter.tick("Copied %d images")
-	counter.end("Copied %d images")
+			# Workers only need the placement options, which pickle cheaply
+			placement = argparse.Namespace(mode=options.mode, verify=options.verify)
+			tasks = ( (input_file_path, output_dir, placement, fused['plan']) for input_file_path, output_dir in to_place() )
+			for task, (record, cache_row, row) in stats_results(tasks, options, reduce_task):
+				if cache_row is not None:
+					fused['cache_rows'].append(cache_row)
+				if row is not None:
+					fused['measured'][row['hash']] = row
+				placed(record)
+	counter.end("Placed %d images")
+	if skipped:
+		log.info("Skipped %d images already placed", skipped)
+	return output_dir_set
+
+
+def reduce_context(options):
+	'''What fused mode workers need to measure images as the reduction pipeline does'''
+	file_options = load_config_file(options.config)
+	opts = merge_options(options, file_options)
+	return {'plan': stats_plan(opts), 'cache_rows': [], 'measured': {}}
+
+
+def reduce_nights(connection, options, output_dir_set, fused):
+	'''Run the reduction pipeline on each night, reusing hashes and statistics already computed'''
+	hash_cache_update(connection, fused['cache_rows'])
+	for output_dir in sorted(output_dir_set):
+		opts = argparse.Namespace(**vars(options))
+		opts.work_dir = output_dir
+		try:
+			do_image_reduce(connection, opts, fused['measured'])
+		except (ConfigError, MetadataError, MixingCandidates) as e:
+			log.error("Could not reduce %s => %s", output_dir, e)
 
 
 # =====================
@@ -108,10 +465,17 @@ def copy_files(image_list):
 
 
 def reorganize_images(connection, options):
+	manifest = manifest_load(options.output_dir)
+	if options.reduce and not options.dry_run:
+		fused = reduce_context(options)
+		output_dir_set = copy_files(scan_images(options, manifest), options, fused)
+		log.info("Images placed in %d directories", len(output_dir_set))
+		reduce_nights(connection, options, output_dir_set, fused)
+		return
 	connection.close()
-	output_dir_set, image_list = scan_images(options)
 	if not options.dry_run:
-		create_dest_directories(output_dir_set)
-		copy_files(image_list)
+		output_dir_set = copy_files(scan_images(options, manifest), options)
+		log.info("Images placed in %d directories", len(output_dir_set))
 	else:
+		output_dir_set = set(output_dir for input_file_path, output_dir, done in scan_images(options, manifest))
 		log.info("Would create %d directories", len(output_dir_set))
@@ -36,11 +36,20 @@ import tabulate
 # local imports
 # -------------
 
+from . import DEF_DB_JOURNAL_MODE, DEF_DB_SYNCHRONOUS, DEF_DB_TEMP_STORE
+from . import DEF_DB_CACHE_SIZE, DEF_DB_MMAP_SIZE, DEF_DB_BUSY_TIMEOUT
 
 # ----------------
 # Module constants
 # ----------------
 
+# Accepted values of keyword database settings
+DB_KEYWORDS = {
+    'journal_mode': ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'),
+    'synchronous' : ('OFF', 'NORMAL', 'FULL', 'EXTRA'),
+    'temp_store'  : ('DEFAULT', 'FILE', 'MEMORY'),
+}
+
 # -----------------------
 # Module global variables
 # -----------------------
@@ -127,21 +136,53 @@ class LogCounter(object):
 # Module global functions
 # -----------------------
 
-def open_database(dbase_path):
+def database_settings(options=None):
+    '''Connection settings, with defaults for missing or invalid values'''
+    settings = {
+        'journal_mode': DEF_DB_JOURNAL_MODE,
+        'synchronous' : DEF_DB_SYNCHRONOUS,
+        'temp_store'  : DEF_DB_TEMP_STORE,
+        'cache_size'  : DEF_DB_CACHE_SIZE,
+        'mmap_size'   : DEF_DB_MMAP_SIZE,
+        'busy_timeout': DEF_DB_BUSY_TIMEOUT,
+    }
+    for key, value in (options or {}).items():
+        if value is None:
+            continue
+        if key in DB_KEYWORDS and str(value).upper() not in DB_KEYWORDS[key]:
+            log.warning("Ignoring invalid database %s '%s'", key, value)
+            continue
+        settings[key] = str(value).upper() if key in DB_KEYWORDS else int(value)
+    return settings
+
+
+def open_database(dbase_path, options=None):
+    '''
+    Connection factory for all database users.
+    Applies WAL journaling and cache, mmap, fsync and locking settings,
+    so that readers do not block the reduction pipeline
+    '''
     if not os.path.exists(dbase_path):
         with open(dbase_path, 'w') as f:
             pass
         log.info("Created database file {0}".format(dbase_path))
-    return sqlite3.connect(dbase_path)
+    settings = database_settings(options)
+    connection = sqlite3.connect(dbase_path, timeout=settings['busy_timeout']/1000.0)
+    cursor = connection.cursor()
+    cursor.execute("PRAGMA journal_mode = {0}".format(settings['journal_mode']))
+    cursor.execute("PRAGMA synchronous = {0}".format(settings['synchronous']))
+    cursor.execute("PRAGMA temp_store = {0}".format(settings['temp_store']))
+    # Negative cache size is given in KB rather than in pages
+    cursor.execute("PRAGMA cache_size = {0}".format(-1024*settings['cache_size']))
+    cursor.execute("PRAGMA mmap_size = {0}".format(1024*1024*settings['mmap_size']))
+    cursor.execute("PRAGMA busy_timeout = {0}".format(settings['busy_timeout']))
+    return connection
 
 
 def create_database(connection, schema_path, data_dir_path, query):
-    created = True
     cursor = connection.cursor()
-    try:
-        cursor.execute(query)
-    except Exception:
-        created = False
+    cursor.execute(query)
+    created = cursor.fetchone()[0] > 0
     if not created:
         with open(schema_path) as f: 
             lines = f.readlines() 
@@ -158,6 +199,56 @@ def create_database(connection, schema_path, data_dir_path, query):
         connection.commit()
 
 
+def schema_version(connection):
+    cursor = connection.cursor()
+    cursor.execute("PRAGMA user_version")
+    return cursor.fetchone()[0]
+
+
+def sql_statements(script):
+    '''Split an SQL script into complete statements'''
+    statement = ''
+    for line in script.splitlines(True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement.strip()
+            statement = ''
+
+
+def migrate_database(connection, migrations_dir_path):
+    '''
+    Apply pending schema migrations, named NNN_description.sql, in order.
+    Each one runs in its own transaction together with its PRAGMA user_version
+    bump, so that an interrupted migration is retried on the next run.
+    Columns already present are skipped, as older releases added some on demand
+    and newly created databases already have them in schema.sql
+    '''
+    version = schema_version(connection)
+    migrations = []
+    for sql_file in glob.glob(os.path.join(migrations_dir_path, '*.sql')):
+        number = int(os.path.basename(sql_file).split('_', 1)[0])
+        if number > version:
+            migrations.append((number, sql_file))
+    cursor = connection.cursor()
+    for number, sql_file in sorted(migrations):
+        log.info("Migrating data model to version {0} from {1}".format(number, os.path.basename(sql_file)))
+        with open(sql_file) as f:
+            script = f.read()
+        try:
+            cursor.execute("BEGIN")
+            for statement in sql_statements(script):
+                try:
+                    cursor.execute(statement)
+                except sqlite3.OperationalError as e:
+                    if not str(e).startswith("duplicate column name"):
+                        raise
+            cursor.execute("PRAGMA user_version = {0:d}".format(number))
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+
+
 
 def merge_two_dicts(d1, d2):
     '''Valid for Python 2 & Python 3'''
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+#--------------------
+# System wide imports
+# -------------------
+
+import os
+import os.path
+import time
+import logging
+import sqlite3
+import argparse
+
+# ---------------------
+# Third party libraries
+# ---------------------
+
+try:
+    # Optional, Linux only
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+#--------------
+# local imports
+# -------------
+
+from .           import AZOTEA_CFG_DIR
+from .exceptions import ConfigError, MetadataError, MixingCandidates
+from .image      import do_image_reduce, manifest_compute, work_dir_cleanup
+
+# ----------------
+# Module constants
+# ----------------
+
+# Events signaling a new file has landed or a new directory was created
+if inotify_simple is not None:
+    WATCH_FLAGS = inotify_simple.flags.CLOSE_WRITE | inotify_simple.flags.MOVED_TO | inotify_simple.flags.CREATE
+
+# -----------------------
+# Module global variables
+# -----------------------
+
+log = logging.getLogger("azotea")
+
+# -----------------------
+# Module global functions
+# -----------------------
+
+def is_work_dir(options, dirpath):
+    '''In multiuser mode, the top directory only holds observer directories'''
+    return not (options.multiuser and dirpath == options.work_dir)
+
+
+def work_dirs(options, base_dir):
+    '''Directories in the upload tree containing files'''
+    result = []
+    for dirpath, dirnames, filenames in os.walk(base_dir):
+        if filenames and is_work_dir(options, dirpath):
+            result.append(dirpath)
+    return result
+
+
+def watch_reduce(connection, options, work_dir):
+    '''Incremental reduction of a single work directory'''
+    opts = argparse.Namespace(**vars(options))
+    opts.work_dir = work_dir
+    if options.multiuser:
+        key = os.path.relpath(work_dir, options.work_dir).split(os.sep)[0]
+        opts.config = os.path.join(AZOTEA_CFG_DIR, key + '.ini')
+    try:
+        processed = do_image_reduce(connection, opts)
+    except (ConfigError, MetadataError, MixingCandidates, IOError, sqlite3.Error) as e:
+        log.error("Could not reduce %s => %s", work_dir, e)
+        connection.rollback()
+        processed = True
+    finally:
+        # The connection outlives this reduction
+        work_dir_cleanup(connection)
+    return processed
+
+
+def watch_reduce_pending(connection, options, pending):
+    '''Reduce directories with no arrivals for the debounce period'''
+    now = time.monotonic()
+    ready = sorted(path for path, tstamp in pending.items() if now - tstamp >= options.debounce)
+    for path in ready:
+        del pending[path]
+        if not os.path.isdir(path):
+            continue
+        log.info("New images landed in %s", path)
+        watch_reduce(connection, options, path)
+
+
+def watch_polling(connection, options):
+    '''Detect arrivals by periodically comparing directory manifests'''
+    log.info("Watching %s by polling every %.1f seconds", options.work_dir, options.interval)
+    manifests = {}
+    pending = {}
+    while True:
+        for path in work_dirs(options, options.work_dir):
+            try:
+                digest = manifest_compute(path, options.config, options.camera)['digest']
+            except OSError:
+                continue    # vanished under our feet or no config file yet
+            if manifests.get(path) != digest:
+                manifests[path] = digest
+                pending[path] = time.monotonic()
+        watch_reduce_pending(connection, options, pending)
+        time.sleep(options.interval)
+
+
+def watch_add(inotify, watches, base_dir):
+    '''Recursively add inotify watches from base_dir downwards'''
+    for dirpath, dirnames, filenames in os.walk(base_dir):
+        wd = inotify.add_watch(dirpath, WATCH_FLAGS)
+        watches[wd] = dirpath
+
+
+def watch_inotify(connection, options):
+    '''Detect arrivals with inotify events'''
+    log.info("Watching %s with inotify", options.work_dir)
+    inotify = inotify_simple.INotify()
+    watches = {}
+    watch_add(inotify, watches, options.work_dir)
+    # Catch up with whatever landed while we were not watching
+    pending = { path: time.monotonic() for path in work_dirs(options, options.work_dir) }
+    while True:
+        for event in inotify.read(timeout=int(options.interval * 1000)):
+            dirpath = watches.get(event.wd)
+            if dirpath is None:
+                continue
+            path = os.path.join(dirpath, event.name)
+            if event.mask & inotify_simple.flags.ISDIR:
+                watch_add(inotify, watches, path)
+                for subdir in work_dirs(options, path):
+                    pending[subdir] = time.monotonic()
+            elif is_work_dir(options, dirpath):
+                pending[dirpath] = time.monotonic()
+        watch_reduce_pending(connection, options, pending)
+
+
+# =====================
+# Command esntry points
+# =====================
+
+def image_watch(connection, options):
+    if inotify_simple is None or options.polling:
+        watch_polling(connection, options)
+    else:
+        watch_inotify(connection, options)
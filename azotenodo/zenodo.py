@@ -16,13 +16,15 @@ import argparse
 import os.path
 import pprint
 import json
-import sqlite3
 
 #--------------
 # local imports
 # -------------
 
 from .packer import make_new_release
+from azotea        import DEF_CONFIG as AZOTEA_CONFIG
+from azotea.utils  import open_database as azotea_open_database
+from azotea.config import load_database_options
 from . import SANDBOX_DOI_PREFIX, SANDBOX_URL_PREFIX, PRODUCTION_URL_PREFIX, PRODUCTION_DOI_PREFIX, DEF_DBASE
 # -----------------------
 # Module global variables
@@ -50,11 +52,8 @@ def setup_context(options, file_options):
 
 
 def open_database(dbase_path):
-    if not os.path.exists(dbase_path):
-        with open(dbase_path, 'w') as f:
-            pass
-        log.info("Created database file {0}".format(dbase_path))
-    return sqlite3.connect(dbase_path)
+    '''Same connection settings as the AZOTEA tool, since this is the same database'''
+    return azotea_open_database(dbase_path, load_database_options(AZOTEA_CONFIG))
 
 
 def select_contributors(connection):
@@ -47,6 +47,7 @@ PACKAGE_DATA = {
                 'data/azotea.ini',
                 'data/sql/*.sql',
                 'data/sql/data/*.sql',
+                'data/sql/migrations/*.sql',
               ],
     'azotenodo': [
                 'data/azotenodo.ini',
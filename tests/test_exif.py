@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# ----------------------------------------------------------------------
+# Copyright (c) 2020
+#
+# See the LICENSE file for details
+# see the AUTHORS file for authors
+# ----------------------------------------------------------------------
+
+#--------------------
+# System wide imports
+# -------------------
+
+import os
+import sys
+import shutil
+import tempfile
+import importlib
+import unittest
+
+# ----------------
+# Module constants
+# ----------------
+
+# Stand-in for exiftool -stay_open: answers every -execute with one JSON
+# item per file, counting commands in the camera model so that tests can
+# tell how many round trips were made. Files named *.junk are not understood
+FAKE_EXIFTOOL = '''#!{python}
+import sys, json
+args = []
+n = 0
+for line in sys.stdin:
+    line = line.rstrip('\\n')
+    if line == '-execute':
+        n += 1
+        files = [ a for a in args if not a.startswith('-') and a != 'filename=utf8' ]
+        items = []
+        for f in files:
+            if f.endswith('.junk'):
+                items.append({{"SourceFile": f}})
+            else:
+                items.append({{"SourceFile": f, "Model": "Fake %d" % n, "ISO": 800,
+                    "DateTimeOriginal": "2020:01:01 22:00:00", "FocalLength": "18.0 mm",
+                    "FNumber": 2.8, "ExposureTime": "1/30"}})
+        print(json.dumps(items))
+        print("{{ready}}", flush=True)
+        args = []
+    elif line == 'False' and args and args[-1] == '-stay_open':
+        sys.exit(0)
+    else:
+        args.append(line)
+'''
+
+# ====================
+# Test Case definition
+# ====================
+
+class ExifToolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        executable = os.path.join(self.tmp_dir, 'exiftool')
+        with open(executable, 'w') as f:
+            f.write(FAKE_EXIFTOOL.format(python=sys.executable))
+        os.chmod(executable, 0o755)
+        self.environ = os.environ.get('AZOTEA_EXIFTOOL')
+        os.environ['AZOTEA_EXIFTOOL'] = executable
+        import azotea.exif
+        self.exif = importlib.reload(azotea.exif)
+        self.files = []
+        for name in ('a.cr3', 'b.cr3', 'c.junk'):
+            path = os.path.join(self.tmp_dir, name)
+            with open(path, 'wb') as f:
+                f.write(b'\x00' * 1024)     # Not TIFF based
+            self.files.append(path)
+
+    def tearDown(self):
+        if self.exif._exiftool is not None:
+            self.exif._exiftool.close()
+        if self.environ is None:
+            del os.environ['AZOTEA_EXIFTOOL']
+        else:
+            os.environ['AZOTEA_EXIFTOOL'] = self.environ
+        shutil.rmtree(self.tmp_dir)
+
+    def test_lookup(self):
+        result = self.exif.exiftool_lookup(self.files)
+        self.assertEqual(result[0]['Image Model'], 'Fake 1')
+        self.assertEqual(result[1]['Image Model'], 'Fake 1')
+        self.assertEqual(result[0]['EXIF FocalLength'], 18)
+        self.assertEqual(result[0]['EXIF ExposureTime'], '1/30')
+        self.assertIsNone(result[2])
+
+    def test_session_is_shared(self):
+        self.exif.exiftool_lookup(self.files[:1])
+        result = self.exif.exiftool_lookup(self.files[1:2])
+        self.assertEqual(result[0]['Image Model'], 'Fake 2')
+
+    def test_needed(self):
+        self.assertIsNone(self.exif.header_exif(self.files[0]))
+
+    def test_prefetch_in_batches(self):
+        self.exif.EXIFTOOL_BATCH = 2
+        self.exif.exiftool_prefetch(self.files)
+        self.assertEqual(self.exif.exiftool_prefetched(self.files[0])['Image Model'], 'Fake 1')
+        self.assertEqual(self.exif.exiftool_prefetched(self.files[1])['Image Model'], 'Fake 1')
+        self.assertIsNone(self.exif.exiftool_prefetched(self.files[2]))
+        # Each prefetched result is used only once
+        self.assertIsNone(self.exif.exiftool_prefetched(self.files[0]))
+
+
+if __name__ == '__main__':
+    unittest.main()